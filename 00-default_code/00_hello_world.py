@@ -9,34 +9,113 @@
 ###
 
 DATASET_NAMES = ['example_dataset'] # .csv
+WINDOW_DAYS = None # Read just the last N days of the datasets; None - all the data
 OUTPUT_TYPE = 'jpg'
 
+import time
+import os
+import tempfile
+import_started = time.perf_counter()
+
+home = os.path.expanduser('~')
+if 'MPLCONFIGDIR' not in os.environ and not (os.path.isdir(home) and os.access(home, os.W_OK)):
+    # Matplotlib would build its font cache in a new temporary folder on each start; keep it in one instead
+    os.environ['MPLCONFIGDIR'] = os.path.join(tempfile.gettempdir(), 'matplotlib')
+import matplotlib
+matplotlib.use('Agg') # Images only - no looking for a GUI backend
+
 import pandas as pd
+import numpy as np
 import base64
+import io
+import hashlib
 import matplotlib.pyplot as plt
-import csv
 
-def covert_to_numeric(df,drop_nonnumeric):
-    columns_to_drop = []
-    for column in df.columns:
-        original_data = df[column].copy()
-        original_data = original_data.str.strip()
-        mask_empty = original_data == ''
-        converted_data = pd.to_numeric(original_data, errors='coerce')
-        converted_data_masked = converted_data.copy()
-        converted_data_masked[mask_empty] = 0 # Convert empty strings as NaN
-
-        if converted_data_masked.isna().sum() > 0:
-            df.loc[:, column] = original_data
-            columns_to_drop.append(column)
-        else:
-            df.loc[:, column] = converted_data
+IMPORT_SECONDS = time.perf_counter() - import_started # The cold start; printed when run locally
 
+numeric_columns = {} # Column names of a frame -> (its string columns found numeric, a value of each of the other
+                     # string columns that is not a number), the schema hint for the next calls
+
+def covert_to_numeric(df, drop_nonnumeric):
+    """Converts the string columns that hold only numbers (or empty strings) to numbers; the other string
+    columns are stripped of white space, or dropped if drop_nonnumeric.
+
+    All the string columns are parsed together, in one vectorized pass. The columns found numeric are
+    remembered by the column names of the frame, so the next calls with the same columns parse just those.
+    The columns are inferred again if a numeric column gets a value that is not a number, or if the value
+    that made a column non-numeric is gone (e.g. it left the time window of the dataset).
+    """
+    key = tuple(df.columns)
+    text_columns = [column for column in df.columns if not pd.api.types.is_numeric_dtype(df[column])]
+    hint = numeric_columns.get(key)
+    if hint is not None and all((df[column] == value).any() for column, value in hint[1].items()):
+        columns = hint[0]
+    else:
+        hint = None
+        columns = text_columns
+
+    raw = df[columns].to_numpy(dtype=object)
+    stripped = pd.Series(raw.ravel(order='F'), dtype=object).str.strip()
+    converted = pd.to_numeric(stripped, errors='coerce')
+    bad = (converted.isna() & (stripped != '')).to_numpy().reshape(len(columns), len(df))
+    invalid = bad.any(axis=1)
+    if hint is not None and invalid.any():
+        del numeric_columns[key] # A new kind of values, infer the columns again
+        return covert_to_numeric(df, drop_nonnumeric)
+
+    values = converted.to_numpy().reshape(len(columns), len(df))
+    stripped = stripped.to_numpy().reshape(len(columns), len(df))
+    for i, column in enumerate(columns):
+        if not invalid[i]:
+            df[column] = values[i]
+        elif not drop_nonnumeric:
+            df[column] = stripped[i]
+    if hint is None:
+        numeric_columns[key] = ([column for column, b in zip(columns, invalid) if not b],
+                                {column: raw[bad[i].argmax(), i] for i, column in enumerate(columns) if invalid[i]})
+
+    nonnumeric = [column for column in text_columns if column not in numeric_columns[key][0]]
     if drop_nonnumeric:
-        df.drop(columns=columns_to_drop, inplace=True)
+        df.drop(columns=nonnumeric, inplace=True)
+    elif hint is not None:
+        for column in nonnumeric:
+            df[column] = df[column].str.strip()
 
     return df
 
+# Plot just the points that make a difference in the image - see decimate(). A larger image from the same figure,
+# e.g. /img?w=1920 of server.py, then lacks some details; set DECIMATE = False for it.
+DECIMATE = True
+
+def decimate(df, width):
+    """Keeps the rows of df that draw the same lines in a plot width pixels wide: in each pixel column, the first
+    and the last row and the rows with the lowest and the highest value of each column, so the spikes stay.
+    It is at most four rows per pixel column and column, whatever the number of rows.
+        - df.index - ascending timestamps (or numbers); else df is returned as it is
+        - df[:] - numeric data
+    """
+    if len(df) <= width or not df.index.is_monotonic_increasing:
+        return df
+
+    x = df.index.to_numpy()
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype('int64')
+    x = x.astype(float)
+    if x[-1] == x[0]:
+        return df
+    pixel = np.minimum(((x - x[0]) / (x[-1] - x[0]) * width).astype(int), width - 1)
+
+    keep = np.zeros(len(df), dtype=bool)
+    first = np.r_[True, pixel[1:] != pixel[:-1]]
+    keep |= first | np.r_[first[1:], True] # The first and the last row of each pixel column
+    for column in df.columns:
+        values = pd.Series(df[column].to_numpy(dtype=float))
+        # A missing value is never the lowest or the highest, unless all of the pixel column is missing - then
+        # one of them is kept, so that the line breaks there as before
+        keep[values.fillna(np.inf).groupby(pixel).idxmin().to_numpy()] = True
+        keep[values.fillna(-np.inf).groupby(pixel).idxmax().to_numpy()] = True
+    return df[keep]
+
 def plotimg(df):
     """df = dataframe:
         - df.index - timestamp, not time-zone aware, in UTC.
@@ -46,38 +125,65 @@ def plotimg(df):
 
     print(df.head()) # It won't show anything in the cloud, but it does when ran locally.
 
-    plt.figure(figsize=(6.4, 4.8), dpi=100) # 640 x 480 pixels
+    fig = plt.figure(figsize=(6.4, 4.8), dpi=100) # 640 x 480 pixels
+    if DECIMATE:
+        df = decimate(df, int(fig.get_figwidth() * fig.dpi))
     plt.plot(df)
 
-    plt.savefig('/tmp/img' + OUTPUT_TYPE, format=OUTPUT_TYPE)
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format=OUTPUT_TYPE)
     plt.close()
 
-    return "/tmp/img" + OUTPUT_TYPE
+    return buffer.getvalue()
 
-def returnimg(ff):
-    with open(ff, 'rb') as image_file:
-        img = image_file.read()
+RAW_RESPONSE = globals().get('TWO_MINLOG_EXECUTION_ENV') == 'local-server' # server.py takes the image bytes as they are
 
-    body = base64.b64encode(img).decode('utf-8')
+def returnimg(img):
+    """img - the encoded image. The cloud takes it base64-encoded; the local server takes the bytes as they are,
+    with no encoding and no copy."""
+    if RAW_RESPONSE:
+        body = img
+    else:
+        body = base64.b64encode(img).decode('utf-8')
 
     response = {
         'headers': {"Content-Type": "image/" + OUTPUT_TYPE},
         'statusCode': 200,
         'body': body,
-        'isBase64Encoded': True
+        'isBase64Encoded': not RAW_RESPONSE
     }
     return response
 
+# The responses of the last renders, by the hash of the data. The script may stay loaded between the calls,
+# so the same data are not rendered twice; a changed script is loaded anew, with an empty cache.
+RENDER_CACHE_SIZE = 8
+render_cache = {}
+
+def data_hash(dfs, *extra):
+    """Hash of the data frames - the index, the column names and the values; extra is hashed too."""
+    h = hashlib.sha1(repr(extra).encode())
+    for df in dfs:
+        h.update(repr(list(df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df).values.tobytes())
+    return h.hexdigest()
+
 def handler(dfs):
+    key = data_hash(dfs)
+    if key in render_cache:
+        return render_cache[key]
+
     if len(dfs) > 0:
         df = dfs[0]
     else: # If dfs = [] let's set some dummy graph
         df = pd.DataFrame({'timestamp': [0,1], 'value': [1,2]}).set_index('timestamp')
 
-    ff = plotimg(df)
+    img = plotimg(df)
 
-    response = returnimg(ff)
+    response = returnimg(img)
 
+    render_cache[key] = response
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        del render_cache[next(iter(render_cache))]
     return response
 
 
@@ -85,30 +191,69 @@ def handler(dfs):
 ### Code to run locally, mimicking the cloud environment
 if 'TWO_MINLOG_EXECUTION_ENV' not in globals():
     import os
-    import tempfile
     import pandas as pd
     import base64
+    import csv
+    from datetime import datetime, timedelta
+    from concurrent.futures import ThreadPoolExecutor
 
-    os.makedirs("/tmp", exist_ok=True)
-    globals()['MPLCONFIGDIR'] = tempfile.mkdtemp(dir='/tmp')
+    print(f'Imports: {IMPORT_SECONDS:.2f} s (python -X importtime shows each module)')
 
-    csvs = []
-    for DSN in DATASET_NAMES:
-        with open( DSN + '.csv', 'r') as f:
-            reader = csv.reader(f)
-            data = [row for row in reader]
-            csvs.append(data)
+    def reversed_lines(f, start):
+        """Yields (offset, line) of the lines of the binary file f after the offset start, from the last one."""
+        end = f.seek(0, os.SEEK_END)
+        rest = b''
+        while end > start:
+            block_start = max(start, end - 1024 * 1024)
+            f.seek(block_start)
+            data = f.read(end - block_start) + rest
+            lines = data.split(b'\n')
+            rest = lines.pop(0) if block_start > start else b'' # The first line may begin in the previous block
+            offset = block_start + len(data)
+            for line in reversed(lines):
+                offset -= len(line)
+                yield offset, line
+                offset -= 1 # The newline
+            end = block_start
 
-    dfs = []
-    for csv in csvs:
-        if csv == [[]]:
-            continue
+    def read_window(path, window_days):
+        """The header and the lines of the last window_days days of the data in the CSV file path, as bytes.
+        The file is read from the end, until the first line older than the window, so the time does not grow
+        with the history. window_days None - the whole file."""
+        with open(path, 'rb') as f:
+            header = f.readline()
+            if window_days is None or not header.strip():
+                return header + f.read()
+            column = [name.strip() for name in next(csv.reader([header.decode()]))].index('timestamp')
+            data_start = f.seek(0, os.SEEK_END)
+            newest = None
+            for offset, line in reversed_lines(f, len(header)):
+                if not line.strip():
+                    continue
+                timestamp = datetime.fromisoformat(next(csv.reader([line.decode()]))[column].strip())
+                if newest is None:
+                    newest = timestamp
+                elif timestamp < newest - timedelta(days=window_days):
+                    break
+                data_start = offset
+            f.seek(data_start)
+            return header + f.read()
 
-        df = pd.DataFrame(data=csv[1:], columns=csv[0])
+    def load_dataset(dataset_name):
+        """Reads DATASET_NAME.csv as the cloud passes it to handler() - string values, indexed by the timestamps."""
+        try:
+            # The C parser of pandas reads the file straight into columns; the values stay strings, as in the cloud
+            data = read_window(dataset_name + '.csv', WINDOW_DAYS)
+            df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, engine='c')
+        except pd.errors.EmptyDataError: # Not even a header
+            return None
         df.columns = df.columns.str.strip() # Strip white spaces around elements
         df.set_index('timestamp', inplace=True)
         df.index = pd.to_datetime(df.index, format='ISO8601')
-        dfs.append(df)
+        return df
+
+    with ThreadPoolExecutor() as executor: # The datasets are read in parallel
+        dfs = [df for df in executor.map(load_dataset, DATASET_NAMES) if df is not None]
 
     result = handler(dfs)
 
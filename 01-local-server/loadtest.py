@@ -0,0 +1,290 @@
+# Load test of the local server (server.py) - simulates a fleet of 2minlog devices.
+#
+# Start server.py, then run this script. It sends the logs of a synthetic fleet for DURATION seconds:
+# - 'arduino' - GET /log?datasetSecret=...&level=...&temperature=..., as wifi_arduino_thermometer.ino does,
+# - 'synology' - POST /log with a JSON record per disk and HTTP Basic authentication, as synology-temperature.py,
+# - 'ping' - GET /log?datasetSecret=... with no values, as interval-ping.py.
+# Each device opens a new connection for each log, as the real devices do. The logs are sent on schedule
+# (open loop), so a slow server shows up as latency, not as a lower request rate.
+#
+# Set REPLAY_FILE to a RAWDATAFILE (e.g. 'raw_example_dataset.log') to replay its records instead, REPLAY_SPEED
+# times faster than they were logged, as JSON POSTs with their original timestamps.
+#
+# The report shows the sustained throughput, p50/p99 ingest latency, the render lag (time from a log - GET or POST,
+# both trigger a render - to the next image event on /img/events), the file sizes and the server-side times from
+# /metrics.
+#
+# Run it against a copy of your data - the logs are stored as any other.
+#
+
+import http.client
+import urllib.parse
+import json
+import base64
+import heapq
+import bisect
+import queue
+import random
+import socket
+import threading
+import time
+import os
+
+SERVER = 'http://localhost:8000'
+DURATION = 60 # seconds
+WORKERS = 32 # Threads sending the logs; enough to keep the schedule while the server is slow
+
+# Each group: kind, number of devices, seconds between two logs of a device, datasetSecret (None - the default
+# dataset). Shorten the intervals to load the server more; e.g. 100 devices every second is 100 logs/s.
+FLEET = [
+    {'kind': 'arduino', 'devices': 50, 'interval': 1, 'secret': None},
+    {'kind': 'synology', 'devices': 10, 'interval': 5, 'secret': None, 'disks': 4},
+    {'kind': 'ping', 'devices': 5, 'interval': 1, 'secret': None},
+]
+
+REPLAY_FILE = None # e.g. 'raw_example_dataset.log'
+REPLAY_SPEED = 60 # Replay one minute of the log per second
+REPLAY_SECRET = None
+
+DATASET = None # Dataset name for the render lag (/img/events); None - the default dataset
+DATASET_SECRET = None # datasetSecret of DATASET, needed to watch its image events
+FILES = ['raw_example_dataset.log', 'example_dataset.csv', 'output.jpg'] # Sizes reported at the end, if found
+
+server_url = urllib.parse.urlparse(SERVER)
+
+
+class Request:
+    def __init__(self, method, path, body=None, headers=None):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers or {}
+
+
+def secret_query(secret):
+    return {'datasetSecret': secret} if secret else {}
+
+
+def arduino_request(device, secret):
+    query = {**secret_query(secret), 'level': random.randint(0, 1023),
+             'temperature': f'{20 + 5 * random.random() + device % 5:.2f}'}
+    return [Request('GET', '/log?' + urllib.parse.urlencode(query))]
+
+
+def synology_request(device, secret, disks):
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['Authorization'] = 'Basic ' + base64.b64encode(f'2minlog:{secret}'.encode()).decode()
+    return [Request('POST', '/log', json.dumps({
+        'server_name': f'Synology{device}', 'ip': f'10.0.0.{device % 250}', 'disk': str(disk),
+        'name': f'Drive {disk}', 'model': 'HAT5300-8T', 'temperature': str(random.randint(30, 45)),
+    }).encode(), headers) for disk in range(1, disks + 1)]
+
+
+def ping_request(device, secret):
+    return [Request('GET', '/log?' + urllib.parse.urlencode(secret_query(secret)))]
+
+
+def fleet_schedule(start):
+    """Yields (time, requests) of the synthetic fleet, in time order."""
+    devices = []
+    for group in FLEET:
+        for device in range(group['devices']):
+            # The devices of a group are spread over its interval, not synchronized
+            devices.append([start + random.random() * group['interval'], len(devices), device, group])
+    heapq.heapify(devices)
+
+    while devices[0][0] < start + DURATION:
+        due, n, device, group = devices[0]
+        if group['kind'] == 'arduino':
+            requests = arduino_request(device, group['secret'])
+        elif group['kind'] == 'synology':
+            requests = synology_request(device, group['secret'], group.get('disks', 1))
+        else:
+            requests = ping_request(device, group['secret'])
+        yield due, requests
+        heapq.heapreplace(devices, [due + group['interval'], n, device, group])
+
+
+def replay_schedule(start):
+    """Yields (time, requests) replaying REPLAY_FILE, REPLAY_SPEED times faster."""
+    from datetime import datetime
+
+    first = None
+    with open(REPLAY_FILE, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                timestamp = datetime.fromisoformat(record['timestamp']).timestamp()
+            except (ValueError, KeyError):
+                continue
+            if first is None:
+                first = timestamp
+            due = start + (timestamp - first) / REPLAY_SPEED
+            if due >= start + DURATION:
+                return
+            record.pop('datasetSecret', None)
+            yield due, [Request('POST', '/log?' + urllib.parse.urlencode(secret_query(REPLAY_SECRET)),
+                                json.dumps(record).encode(), {'Content-Type': 'application/json'})]
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = [] # seconds
+        self.lateness = [] # seconds the requests were sent after their schedule
+        self.sent_at = [] # time.time() of the successful logs
+        self.errors = {}
+
+    def add(self, latency, lateness, sent_at):
+        with self.lock:
+            self.latencies.append(latency)
+            self.lateness.append(lateness)
+            self.sent_at.append(sent_at)
+
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def send(request):
+    connection = http.client.HTTPConnection(server_url.hostname, server_url.port or 80, timeout=30)
+    try:
+        connection.request(request.method, request.path, body=request.body,
+                           headers={'Connection': 'close', **request.headers})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def run_worker(work, results):
+    while True:
+        item = work.get()
+        if item is None:
+            return
+        due, request = item
+        started = time.time()
+        try:
+            status = send(request)
+        except (OSError, http.client.HTTPException) as e:
+            results.error(type(e).__name__)
+            continue
+        if status == 200:
+            results.add(time.time() - started, started - due, started)
+        else:
+            results.error(f'HTTP {status}')
+
+
+def watch_images(events, stop):
+    """Collects the times of the image events of DATASET, for the render lag."""
+    path = '/img/events' + ('?' + urllib.parse.urlencode({'dataset': DATASET, **secret_query(DATASET_SECRET)})
+                            if DATASET else '')
+    try:
+        sock = socket.create_connection((server_url.hostname, server_url.port or 80), timeout=1)
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: {server_url.netloc}\r\n\r\n'.encode())
+    except OSError as e:
+        print(f'Cannot watch the image events: {e}')
+        return
+
+    data = b''
+    with sock:
+        while not stop.is_set():
+            try:
+                chunk = sock.recv(4096)
+            except socket.timeout:
+                continue
+            if not chunk:
+                return
+            data += chunk
+            while b'\n\n' in data:
+                message, data = data.split(b'\n\n', 1)
+                if b'event: image' in message:
+                    events.append(time.time())
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def scrape_metrics():
+    """The sums and counts of the server-side histograms from /metrics."""
+    try:
+        connection = http.client.HTTPConnection(server_url.hostname, server_url.port or 80, timeout=10)
+        connection.request('GET', '/metrics')
+        text = connection.getresponse().read().decode()
+        connection.close()
+    except (OSError, http.client.HTTPException):
+        return {}
+
+    values = {}
+    for line in text.splitlines():
+        if line.startswith('#') or '_bucket' in line:
+            continue
+        name, value = line.rsplit(' ', 1)
+        values[name] = float(value)
+    return values
+
+
+def report(results, events, elapsed):
+    ok = len(results.latencies)
+    print()
+    print(f'Logs sent: {ok} OK, errors: {results.errors or 0}, in {elapsed:.1f} s')
+    print(f'Throughput: {ok / elapsed:.1f} logs/s')
+    print(f'Ingest latency: p50 {1000 * percentile(results.latencies, 50):.1f} ms, '
+          f'p99 {1000 * percentile(results.latencies, 99):.1f} ms, max {1000 * max(results.latencies, default=0):.1f} ms')
+    print(f'Sent behind schedule: p99 {1000 * percentile(results.lateness, 99):.1f} ms')
+
+    events.sort()
+    lags = []
+    for sent_at in results.sent_at:
+        i = bisect.bisect_left(events, sent_at)
+        if i < len(events):
+            lags.append(events[i] - sent_at)
+    print(f'Images: {len(events)}, render lag: p50 {percentile(lags, 50):.2f} s, p99 {percentile(lags, 99):.2f} s')
+
+    for file in FILES:
+        if os.path.exists(file):
+            print(f'{file}: {os.path.getsize(file) / 1024:.1f} kB')
+
+    metrics = scrape_metrics()
+    for name in sorted(metrics):
+        if '_seconds_sum' in name:
+            count = metrics.get(name.replace('_seconds_sum', '_seconds_count', 1), 0)
+            if count:
+                print(f"{name.replace('_sum', '', 1)}: {count:.0f} x, mean {1000 * metrics[name] / count:.1f} ms")
+        elif name.startswith('twominlog_bytes_written_total'):
+            print(f'{name}: {metrics[name] / 1024:.1f} kB')
+
+
+if __name__ == '__main__':
+    results = Results()
+    events = []
+    stop = threading.Event()
+    threading.Thread(target=watch_images, args=(events, stop), daemon=True).start()
+
+    work = queue.Queue()
+    workers = [threading.Thread(target=run_worker, args=(work, results), daemon=True) for _ in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    start = time.time() + 1
+    schedule = replay_schedule(start) if REPLAY_FILE else fleet_schedule(start)
+    print(f'Sending logs to {SERVER} for {DURATION} s')
+    for due, requests in schedule:
+        time.sleep(max(0, due - time.time()))
+        for request in requests:
+            work.put((due, request))
+
+    for _ in workers:
+        work.put(None)
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    time.sleep(3) # The last renders
+    stop.set()
+    report(results, events, elapsed)
@@ -10,16 +10,94 @@
 #
 # Logging:
 # - path /log, e.g. http://localhost:8000/log
-# - Creates internal data file RAWDATAFILE and cvs file CSVFILE
-# - It ignores datasetSecret parameter
-# - If TWO_MINLOG_SCRIPT if non-empty, it runs the script and creates the graph defined in the script. It does not
-#   pass any parameters - you need to set the correct intput csv and output jpg file names in the script. For a start,
-#   you can upload https://raw.githubusercontent.com/2minlog/2minlog-examples/main/00-default_code/00_hello_world.py
-#   script.
+# - Requests are served concurrently. The handlers only queue the records; a single writer thread stores them,
+#   so the files are written by one thread only.
+# - The image is generated in the background, after both GET and POST logs. Bursts of logs are coalesced into one
+#   render, and the renders start at least RENDER_MIN_INTERVAL seconds apart.
+# - Creates internal data file RAWDATAFILE and cvs file CSVFILE (set CSV_EXPORT = False to skip the CSV file)
+# - CSVFILE is rebuilt from RAWDATAFILE at startup; then each record is just appended to it. It is rewritten
+#   only when a record brings a new column.
+# - STORAGE = 'segments' stores the data in columnar files per day, in the <name>_segments folder, instead of
+#   RAWDATAFILE (an existing RAWDATAFILE is imported once). Reading a time window, e.g. the last RENDER_WINDOW_DAYS
+#   days loaded for the renders, touches only the files of those days, which keeps years of minute data usable
+#   even on a Raspberry Pi.
+# - Retention: MAX_POINTS and/or MAX_AGE_DAYS (or per dataset in DATASETS) bound each dataset, e.g. 50,400 points
+#   for five weeks of minute data. The oldest records are dropped in the background every RETENTION_INTERVAL
+#   seconds - from memory right away, from the files once they exceed the limits by RETENTION_SLACK (RAWDATAFILE
+#   is rewritten) or, with segments, by whole days. The files are compacted by the writer thread of the dataset,
+#   which rebuilds the CSV right after; the logs that arrive meanwhile wait in its queue.
+# - One server can keep more datasets, see DATASETS. The records are routed by datasetSecret - the query string
+#   parameter, the password of HTTP Basic authentication (curl --user, or send_log() in synology-temperature.py)
+#   or a datasetSecret field of the record. Records with no or unknown datasetSecret go to the default dataset.
+# - If TWO_MINLOG_SCRIPT if non-empty, it runs the script and creates the graph defined in the script. The script
+#   is imported once into a separate render worker process and its handler(dfs) is called with the logged data,
+#   kept in memory - the script's DATASET_NAMES and CSVFILE are not used for it. The image is saved
+#   to FILE_TO_SERVE. For a start, you can upload
+#   https://raw.githubusercontent.com/2minlog/2minlog-examples/main/00-default_code/00_hello_world.py script.
+# - The script is re-imported when its file changes. If it crashes or runs longer than RENDER_TIMEOUT, the
+#   render worker is restarted. The time of each import (the cold start of the script) is in /metrics as
+#   script_load_seconds.
+# - The rendered images are cached by the version of the data and the hash of the script source, so the same
+#   data are never rendered twice by the same script, and an image that did not change is not announced again.
+# - The script's module has TWO_MINLOG_EXECUTION_ENV = 'local-server'. Its handler may then return the image
+#   bytes as they are in 'body' (with 'isBase64Encoded': False) instead of the base64 string of the cloud, which
+#   saves encoding, decoding and a third of the data sent from the render worker.
+# - PROFILE_RENDERS = True times the stages of each render - handler(), the script's preprocess(),
+#   covert_to_numeric(), plotimg() and returnimg() if it has them, and Figure.savefig() - and measures their peak
+#   memory (tracemalloc), with no change to the script. The render response gets the Server-Timing and
+#   X-Render-Peak-Memory headers, the server prints them and exports them in /metrics. PROFILE_DIR keeps a cProfile
+#   dump of each render too, e.g. for snakeviz.
+#
+# Bulk logging:
+# - POST /log also accepts a JSON array of objects or NDJSON (one JSON object per line). The whole batch is
+#   validated first (400 if any record is invalid) and stored with a single append; a batch is then rendered once.
+# - A record may carry its own "timestamp" in ISO 8601 format, e.g. "2024-09-01T12:00:00"; otherwise the time
+#   of receipt is used. The timestamps are stored in UTC, with no offset, as 2minlog hands them to the graph
+#   scripts; a timestamp without an offset is taken as UTC, one with an offset is converted. (The files of older
+#   versions of this server hold the local time.)
+# - FSYNC_POLICY = 'commit' fsyncs RAWDATAFILE after each commit and replies OK once the data are on disk, or
+#   503 Service Unavailable if they could not be stored. With STORAGE = 'segments' it fsyncs every file the commit
+#   appends to - one per column and the timestamps, for each day - so a commit costs more fsyncs there.
+#
+# Data:
+# - path /data, e.g. http://localhost:8000/data?from=2024-09-01T00:00:00&to=2024-09-02T00:00:00&columns=temperature
+# - Returns the records of a time range (from and to are inclusive, both optional) as CSV in the format of
+#   CSVFILE, or as JSON columns with &format=json. ?dataset=<name> selects the dataset, columns=a,b the columns.
+#   A dataset from DATASETS is read only with its datasetSecret - the query string parameter or the password of
+#   HTTP Basic authentication, as for logging; otherwise the response is 401. The default dataset is open to all.
+#   The times are in UTC unless they have an offset, whose plus sign needs to be escaped as %2B. RAWDATAFILE is
+#   indexed by time in memory, so a range is read by seeking into the file, not by scanning all of it. Records
+#   logged late (with an older timestamp than one logged before) are indexed aside, and the retention writes them
+#   back in time order.
+# - &bucket=<seconds> returns <column>_min, <column>_mean and <column>_max of the numeric values in buckets of that
+#   many seconds, e.g. bucket=600 for 10 minutes. The aggregates of the data in memory are cached and updated with
+#   each record.
+# - &points=<n> keeps at most n rows per numeric column, picked by LTTB (Largest-Triangle-Three-Buckets) so that
+#   the plotted line looks the same - enough for a graph that is n pixels wide. RENDER_POINTS does the same for
+#   the data handed to the graph script - in the render worker, with numpy, once for each change of the data.
 #
 # Display image:
 # - path /img, e.g. http://localhost:8000/img
-# - Ignores all the parameters, returns the FILE_TO_SERVE
+# - Returns the FILE_TO_SERVE, or the image of another dataset with ?dataset=<name>&datasetSecret=<its secret>
+#   (the name and the secret from DATASETS; a browser asks for the secret as the password). The latest image is
+#   kept in memory.
+# - Supports ETag/If-None-Match and Last-Modified/If-Modified-Since - a display that already has the latest
+#   image gets just 304 Not Modified. Connections are kept alive (HTTP/1.1), until they are idle for
+#   KEEPALIVE_TIMEOUT seconds.
+# - path /img/events (also with ?dataset=<name>&datasetSecret=<its secret>) - server-sent events (text/event-stream); an event with the image version is sent each time
+#   a new image is rendered, so a display fetches /img only when there is something new. Pass ?v=<version> (or
+#   the Last-Event-ID header) to get an event right away if the image changed since that version. In a web page:
+#   new EventSource('/img/events').addEventListener('image', () => { img.src = '/img?' + Date.now(); });
+# - Variants for other displays: /img?w=<pixels>&h=<pixels>&format=<jpg|png|webp>&dpi=<dpi>, any of them, e.g.
+#   /img?w=3840&h=2160 for a 4K TV. The graph script renders the variant with its figure resized (a missing w or h
+#   keeps the aspect ratio), once per change of the data or of the script. The variants are kept in memory, up to
+#   RENDER_CACHE_BYTES.
+#
+# Metrics:
+# - path /metrics - counters, histograms and gauges in the Prometheus text format: ingest requests and their
+#   latency, records and bytes written per dataset, commit and CSV update times, writer queue depth and pending
+#   renders, render duration and failures per script, /img responses by status (200 vs 304) and SSE clients.
+#   A growing commit_seconds of a dataset shows when its size starts to slow down the ingest.
 #
 #
 # Example of data logging:
@@ -31,14 +109,35 @@
 # curl -X POST --user "2minlog:SEC-xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx" http://localhost:8000/log -d "{\"temperature\":\"451\", \"humidity\":\"80\"}"
 # Linux bash:
 # curl -X POST --user "2minlog:SEC-xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx" http://localhost:8000/log -d "{\"temperature\":\"451\", \"humidity\":\"80\"}"
+# Bulk, Linux bash:
+# curl -X POST --user "2minlog:SEC-xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx" http://localhost:8000/log -d "[{\"temperature\":\"451\"}, {\"temperature\":\"452\", \"timestamp\":\"2024-09-01T12:00:00\"}]"
 #
 
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import urllib.parse
 import json
-from datetime import datetime
-import subprocess
+from datetime import datetime, timedelta, timezone
+import os
+import queue
+import threading
+import time
+import multiprocessing
+import types
+import traceback
+import base64
+import hashlib
+import email.utils
+import selectors
+import socket
+import bisect
+import mmap
+import functools
+import tracemalloc
+import cProfile
+import shutil
+from array import array
+from collections import OrderedDict
 
 PORT = 8000
 HOSTNAME = 'localhost' # 'localhost' or e.g. '10.0.0.10'
@@ -48,61 +147,1844 @@ RAWDATAFILE = 'raw_example_dataset.log'
 TWO_MINLOG_SCRIPT = '00_hello_world.py' # e.g., '' or '00_hello_world.py'
 FILE_TO_SERVE = 'output.jpg'
 
-def to_csv(data):
-    lines = data.strip().split('\n')
-    records = []
+# More datasets in one server, datasetSecret -> dataset. Each dataset keeps its files (<name>.csv,
+# raw_<name>.log, output_<name>.jpg) and has its own render script. Records with no or unknown datasetSecret go
+# to the default dataset above. The names must differ from each other and from the default dataset (the name of
+# CSVFILE without .csv).
+DATASETS = {
+    # 'SEC-xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx': {'name': 'Arduino thermometer', 'script': 'Arduino thermometer.py'},
+    # Optional per dataset: 'storage', 'window_days', 'max_points', 'max_age_days' and 'render_points', see
+    # STORAGE, RENDER_WINDOW_DAYS, MAX_POINTS, MAX_AGE_DAYS and RENDER_POINTS below.
+}
+
+STORAGE = 'rawlog' # 'rawlog' - RAWDATAFILE with JSON lines, 'segments' - columnar files per day in <name>_segments/
+RENDER_WINDOW_DAYS = None # Keep just the last N days in memory for the renders (each retention pass drops the older
+                          # ones); None - everything
+MAX_POINTS = None # Keep at most this many records per dataset, e.g. 5 * 168 * 60 = 50400; None - no limit
+MAX_AGE_DAYS = None # Drop records older than this many days, e.g. 35; None - no limit
+RETENTION_INTERVAL = 60 # seconds between the retention checks
+RETENTION_SLACK = 0.1 # The files are compacted once they exceed the limits by this fraction
+RENDER_POINTS = None # Downsample the data for the renders to at most this many points per column, e.g. 1920; None - all
+CSV_EXPORT = True # Keep CSVFILE up to date; the renders do not need it, they get the data from memory
+RENDER_TIMEOUT = 120 # seconds; a render that takes longer restarts the render worker
+RENDER_MIN_INTERVAL = 2 # seconds between the starts of two renders; the logs in between are rendered together
+RENDER_CACHE_BYTES = 32 * 1024 * 1024 # Memory for the rendered images and /img variants; the least recently used are dropped
+IMAGE_FORMATS = ('jpg', 'png', 'webp')
+SSE_KEEPALIVE = 15 # seconds between keep-alive comments sent to idle /img/events connections
+KEEPALIVE_TIMEOUT = 60 # seconds; an idle keep-alive connection (e.g. of a display that went to sleep) is closed
+FSYNC_POLICY = 'never' # 'never' - leave flushing to the OS, 'commit' - fsync every commit and reply OK only after it
+PROFILE_RENDERS = False # Time the stages of the renders and measure their peak memory; slows the renders down
+PROFILE_DIR = None # With PROFILE_RENDERS, save a cProfile dump of each render into this folder; None - no dumps
+PROFILE_STAGES = ('handler', 'preprocess', 'covert_to_numeric', 'plotimg', 'returnimg') # Profiled functions of the scripts
+
+def csv_line(row):
+    return ", ".join(str(value) for value in row) + "\n"
+
+
+def csv_text(timestamps, columns):
+    """(timestamps, columns) -> CSV in the format of CSVFILE, with the columns sorted by name."""
+    header = sorted([*columns, 'timestamp'])
+    data = [columns[key] if key != 'timestamp' else [us_to_timestamp(t) for t in timestamps] for key in header]
+    return csv_line(header) + ''.join(csv_line(row) for row in zip(*data))
+
+
+EPOCH = datetime(1970, 1, 1)
+DAY_US = 24 * 3600 * 1000000
+
+
+def utc_now():
+    """The current time in UTC, without the time zone - the way the timestamps are stored."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def normalize_timestamp(value):
+    """ISO 8601 timestamp -> naive UTC ISO string, the format the server writes. A timestamp without a UTC offset
+    is taken as UTC."""
+    timestamp = datetime.fromisoformat(str(value))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp.isoformat()
+
+
+def timestamp_to_us(value):
+    return (datetime.fromisoformat(value) - EPOCH) // timedelta(microseconds=1)
+
+
+def now_us():
+    return (utc_now() - EPOCH) // timedelta(microseconds=1)
+
+
+def us_to_timestamp(value):
+    return (EPOCH + timedelta(microseconds=value)).isoformat()
+
+
+def time_param(value):
+    """Query string time -> microseconds since epoch; None if not given. Raises ValueError if invalid."""
+    if value is None or value == '':
+        return None
+    return timestamp_to_us(normalize_timestamp(value))
+
+
+def to_columns(records, columns=None):
+    """Records -> (timestamps, columns): int64 microseconds since epoch and lists of strings.
+
+    A missing value is an empty string, as in the CSV. columns limits the returned columns.
+    """
+    timestamps = array('q')
+    data = {}
+    for record in records:
+        n = len(timestamps)
+        timestamps.append(timestamp_to_us(record['timestamp']))
+        for key, value in record.items():
+            if key == 'timestamp' or (columns is not None and key not in columns):
+                continue
+            column = data.get(key)
+            if column is None:
+                column = data[key] = [''] * n
+            column.append(str(value))
+        for column in data.values():
+            if len(column) == n:
+                column.append('')
+    return timestamps, data
+
+
+def fsync_file(f):
+    if FSYNC_POLICY == 'commit':
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Metrics:
+    """Counters and histograms of the server, exported by /metrics in the Prometheus text format."""
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120) # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [count per bucket..., count over the last bucket, sum]
+        self.gauges = {} # (name, labels) -> the last value set
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    @staticmethod
+    def sample(name, labels, value):
+        labels = ','.join(f'{label}={json.dumps(str(label_value), ensure_ascii=False)}' for label, label_value in labels)
+        return f'twominlog_{name}{{{labels}}} {value}\n' if labels else f'twominlog_{name} {value}\n'
+
+    def export(self, gauges=()):
+        """The metrics as text; gauges are (name, labels, value) of the values measured right now."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self.histograms.items())
+            stored_gauges = sorted(self.gauges.items())
+
+        metrics = {} # Name -> (type, samples)
+        for (name, labels), value in counters:
+            metrics.setdefault(name, ('counter', []))[1].append(self.sample(name, labels, value))
+        for (name, labels), histogram in histograms:
+            samples = metrics.setdefault(name, ('histogram', []))[1]
+            count = 0
+            for le, bucket_count in zip([*self.buckets, '+Inf'], histogram):
+                count += bucket_count
+                samples.append(self.sample(name + '_bucket', (*labels, ('le', le)), count))
+            samples.append(self.sample(name + '_sum', labels, histogram[-1]))
+            samples.append(self.sample(name + '_count', labels, count))
+        for (name, labels), value in stored_gauges:
+            metrics.setdefault(name, ('gauge', []))[1].append(self.sample(name, labels, value))
+        for name, labels, value in gauges:
+            metrics.setdefault(name, ('gauge', []))[1].append(self.sample(name, sorted(labels.items()), value))
+        return ''.join(f'# TYPE twominlog_{name} {kind}\n' + ''.join(samples) for name, (kind, samples) in metrics.items())
+
+
+class OffsetIndex:
+    """Timestamp -> byte offset index of RAWDATAFILE, so that a time range is read by seeking into the file.
+
+    The lines in time order (the usual case, records get the time of receipt) are the main sequence; every
+    stride-th of them is indexed - its timestamp and offset. The first line of a range is found by bisecting
+    the indexed timestamps, and the read stops at the first line past the range. A late line - older than a
+    line before it, e.g. a record with its own past timestamp - is kept aside in the late list with its
+    timestamp and offset, so it does not turn the bisection off; the late lines of a range are read from there.
+    """
+    stride = 64
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.offsets = array('q')
+        self.late_timestamps = array('q')
+        self.late_offsets = array('q')
+        self.rows = 0
+        self.size = 0 # Bytes of the indexed lines
+        self.oldest = None
+        self.newest = None
+
+    def add(self, lines):
+        """Indexes the lines (bytes, with line ends) that follow the lines indexed so far."""
+        for line in lines:
+            timestamp = RawLog.line_timestamp(line)
+            if self.newest is not None and timestamp < self.newest:
+                self.late_timestamps.append(timestamp)
+                self.late_offsets.append(self.size)
+            else:
+                if (self.rows - len(self.late_offsets)) % self.stride == 0:
+                    self.timestamps.append(timestamp)
+                    self.offsets.append(self.size)
+                self.newest = timestamp
+            self.oldest = timestamp if self.oldest is None else min(self.oldest, timestamp)
+            self.rows += 1
+            self.size += len(line)
+
+    def offset(self, start):
+        """Offset to start reading from for the lines of the main sequence with timestamp >= start."""
+        if start is None:
+            return 0
+        i = bisect.bisect_left(self.timestamps, start)
+        return self.offsets[i - 1] if i > 0 else 0
 
-    for line in lines:
+    def late(self, start, end):
+        """Offsets of the late lines with start <= timestamp <= end."""
+        return [offset for timestamp, offset in zip(self.late_timestamps, self.late_offsets)
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end)]
+
+
+class RawLog:
+    """The default storage - RAWDATAFILE, one JSON record per line, with an OffsetIndex kept in memory."""
+
+    def __init__(self, rawdatafile):
+        self.rawdatafile = rawdatafile
+        self.lock = threading.Lock()
+        self.index = OffsetIndex()
+
+    def open(self):
+        index = OffsetIndex()
         try:
-            record = json.loads(line.strip())
-            records.append(record)
-        except json.JSONDecodeError as e:
-            print(f"Failed to parse JSON: {e.msg} in line: {line}")
+            with open(self.rawdatafile, "rb") as f:
+                index.add(f)
+        except FileNotFoundError:
             pass
+        self.index = index
 
-    header = sorted(set().union(*(d.keys() for d in records)))
-    csv_data = [header]
-    for row in records:
-        csv_data.append([row.get(key, '') for key in header])
+    def __len__(self):
+        return self.index.rows
 
-    csv_string = ""
-    for row in csv_data:
-        csv_string += ", ".join(row) + "\n"
+    def append(self, records):
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode()
+        with self.lock:
+            with open(self.rawdatafile, "ab") as f:
+                f.write(data)
+                fsync_file(f)
+            self.index.add(data.splitlines(keepends=True))
+        return len(data)
 
-    return csv_string
+    def compact(self, max_points, cutoff):
+        """Drops the oldest lines over max_points and the lines older than cutoff (microseconds), and writes
+        the lines in time order - also when there are just more late lines than OffsetIndex.stride.
 
+        Run by the writer thread, so nothing is appended meanwhile. The kept lines are copied to a new file;
+        the readers are held off only for the final swap of the files. Returns True if the file was rewritten.
+        """
+        with self.lock:
+            rows, oldest, size = self.index.rows, self.index.oldest, self.index.size
+            late = len(self.index.late_offsets)
+        over_points = max_points is not None and rows > max_points * (1 + RETENTION_SLACK)
+        over_age = (cutoff is not None and oldest is not None
+                    and oldest < cutoff - (now_us() - cutoff) * RETENTION_SLACK)
+        if not over_points and not over_age and late <= OffsetIndex.stride:
+            return False
 
-def handle_data(content):
-    content.pop('datasetSecret', None)
-    print(f'{content=}')
-    timestamp = datetime.now()
-    timestamp = timestamp.isoformat()
-    content["timestamp"] = timestamp
-    with open(RAWDATAFILE, "a") as f:
-        f.write(json.dumps(content) + '\n')
+        with open(self.rawdatafile, "rb") as f:
+            lines = f.read(size).splitlines(keepends=True)
+        # The late lines go back in time order; the sort is stable, so the lines of the same time keep their order
+        lines = sorted(((self.line_timestamp(line), line) for line in lines), key=lambda item: item[0])
+        if cutoff is not None:
+            lines = [(timestamp, line) for timestamp, line in lines if timestamp >= cutoff]
+        lines = [line for _, line in lines]
+        if max_points is not None:
+            lines = lines[-max_points:]
+        index = OffsetIndex()
+        index.add(lines)
 
-    with open(RAWDATAFILE, "r") as f:
-        data = f.read()
-        csv = to_csv(data)
-        with open(CSVFILE, "w") as ff:
-            ff.write(csv)
-            print('Updated', CSVFILE)
+        compacted = self.rawdatafile + '.compact'
+        with open(compacted, "wb") as f:
+            f.write(b''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock:
+            os.replace(compacted, self.rawdatafile)
+            self.index = index
+        return True
 
-def generate_image():
-    if TWO_MINLOG_SCRIPT == '':
-        return
+    @staticmethod
+    def line_timestamp(line):
+        # The lines are written by json.dumps, so the timestamp is usually found without parsing the line
+        start = line.find(b'"timestamp": "')
+        if start >= 0:
+            end = line.find(b'"', start + 14)
+            try:
+                return timestamp_to_us(line[start + 14:end].decode())
+            except ValueError:
+                pass
+        try:
+            return timestamp_to_us(json.loads(line)['timestamp'])
+        except (ValueError, KeyError, TypeError):
+            return -1 # Broken lines are dropped with the oldest ones
+
+    def records(self, start=None, end=None):
+        """Yields the records with start <= timestamp <= end (microseconds) in time order, seeking to start by
+        the index. The late lines of the range out of the lines read are read by their offsets."""
+        with self.lock:
+            index = self.index
+            offset, size, late = index.offset(start), index.size, index.late(start, end)
+            try:
+                f = open(self.rawdatafile, "rb")
+            except FileNotFoundError:
+                return
+        found = []
+        with f:
+            f.seek(offset)
+            read_from, stop = offset, size
+            for line in f.read(size - offset).splitlines(keepends=True):
+                record = self.parse_line(line)
+                if record is None or (start is not None and record[0] < start):
+                    offset += len(line)
+                    continue
+                if end is not None and record[0] > end:
+                    # Not a late line, those are older than a line before them, which was not past the range
+                    stop = offset
+                    break
+                found.append(record)
+                offset += len(line)
+
+            for late_offset in late:
+                if late_offset < read_from or late_offset >= stop:
+                    f.seek(late_offset)
+                    record = self.parse_line(f.readline())
+                    if record is not None:
+                        found.append(record)
+
+        found.sort(key=lambda record: record[0]) # Just the late lines are out of order
+        for _, record in found:
+            yield record
+
+    @staticmethod
+    def parse_line(line):
+        """(timestamp in microseconds, record) of the line; None if the line is broken."""
+        try:
+            record = json.loads(line)
+            return timestamp_to_us(record['timestamp']), record
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Failed to parse JSON: {e} in line: {line}")
+            return None
+
+    def read(self, start=None, end=None, columns=None):
+        """Returns (timestamps, columns) of the records with start <= timestamp <= end (microseconds)."""
+        return to_columns(self.records(start, end), columns)
+
+
+class SegmentStore:
+    """Columnar storage partitioned by day, for a long history.
+
+    Each day is a directory <directory>/<YYYY-MM-DD>/ with:
+    - timestamp.i64 - int64 microseconds since epoch, read through mmap,
+    - columns.json - the column names; column i is stored in c<i>.jsonl, one JSON string per row.
+
+    The sorted list of days with the first and last timestamp of each day is a sparse index kept in
+    memory, so reading e.g. the last 2 days opens only the files of the last two or three days, and
+    within a day the rows are found by bisecting the memory-mapped timestamps.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.days = [] # Sorted day names - the sparse index
+        self.segments = {} # Day -> {'columns': [...], 'rows': n, 'min': us, 'max': us, 'sorted': bool}
+
+    def segment_path(self, day, filename):
+        return os.path.join(self.directory, day, filename)
+
+    @staticmethod
+    def day_of(timestamp):
+        return (EPOCH + timedelta(microseconds=timestamp)).date().isoformat()
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for day in sorted(os.listdir(self.directory)):
+            try:
+                with open(self.segment_path(day, 'columns.json'), 'r') as f:
+                    columns = json.load(f)
+                timestamps = array('q')
+                with open(self.segment_path(day, 'timestamp.i64'), 'rb') as f:
+                    data = f.read()
+                rows = len(data) // timestamps.itemsize
+                timestamps.frombytes(data[:rows * timestamps.itemsize])
+                self.repair_segment(day, len(columns), rows)
+            except (OSError, ValueError) as e:
+                print(f"Skipping segment {day}: {e}")
+                continue
+            if len(timestamps) == 0:
+                continue
+            self.days.append(day)
+            self.segments[day] = {
+                'columns': columns, 'rows': len(timestamps), 'min': min(timestamps), 'max': max(timestamps),
+                'sorted': all(a <= b for a, b in zip(timestamps, timestamps[1:])),
+            }
+
+    def repair_segment(self, day, columns, rows):
+        """Cuts the files of the day back to rows rows - the rest of an interrupted append: values whose
+        timestamps were not written, or a part of a timestamp. Otherwise the rows appended next would get
+        the values of the rows before them."""
+        with open(self.segment_path(day, 'timestamp.i64'), 'a+b') as f:
+            if f.tell() > rows * 8:
+                f.truncate(rows * 8)
+        for i in range(columns):
+            with open(self.segment_path(day, f"c{i}.jsonl"), 'a+b') as f:
+                f.seek(0)
+                data = f.read()
+                end, lines = 0, 0
+                while lines < rows:
+                    newline = data.find(b'\n', end)
+                    if newline < 0:
+                        break
+                    end, lines = newline + 1, lines + 1
+                if end < len(data):
+                    f.truncate(end)
+                if lines < rows: # Not expected - the values are written before the timestamps
+                    f.write(b'""\n' * (rows - lines))
+
+    def __len__(self):
+        return sum(segment['rows'] for segment in self.segments.values())
+
+    def append(self, records):
+        return self.append_columns(*to_columns(records))
+
+    def append_columns(self, timestamps, columns):
+        rows_by_day = {}
+        for row, timestamp in enumerate(timestamps):
+            rows_by_day.setdefault(self.day_of(timestamp), []).append(row)
+
+        written = 0
+        with self.lock:
+            for day, rows in rows_by_day.items():
+                # Every column is stored, even with empty values only, so the schema stays as logged
+                day_columns = {key: [column[row] for row in rows] for key, column in columns.items()}
+                written += self.append_segment(day, array('q', (timestamps[row] for row in rows)), day_columns)
+        return written
+
+    def append_segment(self, day, timestamps, columns):
+        segment = self.segments.get(day)
+        if segment is None:
+            os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+            segment = {'columns': [], 'rows': 0, 'min': timestamps[0], 'max': timestamps[0], 'sorted': True}
+
+        written = 0
+        new_columns = [key for key in columns if key not in segment['columns']]
+        for key in new_columns:
+            # A new column gets empty values for the rows stored before
+            with open(self.segment_path(day, f"c{len(segment['columns'])}.jsonl"), 'w') as f:
+                written += f.write('""\n' * segment['rows'])
+            segment['columns'].append(key)
+        if new_columns or segment['rows'] == 0:
+            with open(self.segment_path(day, 'columns.json'), 'w') as f:
+                json.dump(segment['columns'], f)
+
+        # The values first, the timestamps last - the timestamps count the rows, so an interrupted write
+        # never leaves a row without its values. The values left without their row are cut off, right away
+        # or by open() after a crash.
+        try:
+            for i, key in enumerate(segment['columns']):
+                values = columns.get(key) or [''] * len(timestamps)
+                with open(self.segment_path(day, f"c{i}.jsonl"), 'a') as f:
+                    written += f.write(''.join(json.dumps(value) + '\n' for value in values))
+                    fsync_file(f)
+            with open(self.segment_path(day, 'timestamp.i64'), 'ab') as f:
+                timestamps.tofile(f)
+                fsync_file(f)
+        except OSError:
+            self.repair_segment(day, len(segment['columns']), segment['rows'])
+            raise
+        written += len(timestamps) * timestamps.itemsize
+
+        segment['sorted'] = (segment['sorted'] and (segment['rows'] == 0 or segment['max'] <= timestamps[0])
+                             and all(a <= b for a, b in zip(timestamps, timestamps[1:])))
+        segment['min'] = min(segment['min'], min(timestamps))
+        segment['max'] = max(segment['max'], max(timestamps))
+        segment['rows'] += len(timestamps)
+        if day not in self.segments:
+            self.segments[day] = segment
+            bisect.insort(self.days, day)
+        return written
+
+    def compact(self, max_points, cutoff):
+        """Drops whole days - those older than cutoff, and the oldest ones while the rest has max_points rows."""
+        with self.lock:
+            rows = len(self)
+            dropped = []
+            for day in self.days:
+                segment = self.segments[day]
+                if not ((cutoff is not None and segment['max'] < cutoff)
+                        or (max_points is not None and rows - segment['rows'] >= max_points)):
+                    break
+                dropped.append(day)
+                rows -= segment['rows']
+
+            for day in dropped:
+                self.days.remove(day)
+                del self.segments[day]
+                shutil.rmtree(os.path.join(self.directory, day))
+        return len(dropped) > 0
+
+    def read(self, start=None, end=None, columns=None):
+        """Returns (timestamps, columns) of the rows with start <= timestamp <= end (microseconds)."""
+        with self.lock:
+            first = 0 if start is None else bisect.bisect_left(self.days, self.day_of(start))
+            last = len(self.days) if end is None else bisect.bisect_right(self.days, self.day_of(end))
+            segments = [(day, dict(self.segments[day], columns=list(self.segments[day]['columns'])))
+                        for day in self.days[first:last]]
+
+        timestamps = array('q')
+        data = {}
+        for day, segment in segments:
+            low = segment['min'] if start is None else start
+            high = segment['max'] if end is None else end
+            if segment['max'] < low or segment['min'] > high:
+                continue
+
+            try:
+                n = len(timestamps)
+                rows, row_timestamps = self.read_rows(day, segment, low, high)
+                values = {}
+                for i, key in enumerate(segment['columns']):
+                    if rows and (columns is None or key in columns):
+                        with open(self.segment_path(day, f"c{i}.jsonl"), 'r') as f:
+                            lines = f.readlines()
+                        values[key] = [json.loads(lines[row]) for row in rows]
+            except FileNotFoundError:
+                continue # The day was just dropped by the retention
+
+            timestamps.extend(row_timestamps)
+            for key, column in values.items():
+                data.setdefault(key, [''] * n).extend(column)
+            for column in data.values():
+                if len(column) < len(timestamps):
+                    column.extend([''] * (len(timestamps) - len(column)))
+        return timestamps, data
+
+    def read_rows(self, day, segment, low, high):
+        """Finds the rows of the segment within [low, high]; returns them with their timestamps."""
+        n = segment['rows']
+        with open(self.segment_path(day, 'timestamp.i64'), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as raw, raw.cast('q') as view:
+            if segment['sorted']:
+                rows = range(bisect.bisect_left(view, low, 0, n), bisect.bisect_right(view, high, 0, n))
+            else:
+                rows = [row for row in range(n) if low <= view[row] <= high]
+            row_timestamps = array('q', (view[row] for row in rows))
+        return rows, row_timestamps
+
+
+def open_log(name, rawdatafile, storage):
+    if storage == 'segments':
+        return SegmentStore(name + '_segments')
+    return RawLog(rawdatafile)
+
+
+class CsvMaterializer:
+    """Keeps the CSV file in sync with the stored data without re-reading them on every record.
+
+    The column schema (the CSV header) is kept in memory; a new record is appended as a single CSV
+    row. Only when a record brings a column that has not been seen yet, the CSV is rewritten from
+    the storage once, with the new header.
+    """
+
+    def __init__(self, log, csvfile):
+        self.log = log
+        self.csvfile = csvfile
+        self.header = None
+
+    def rebuild(self):
+        timestamps, columns = self.log.read()
+        if len(timestamps) == 0 and not os.path.exists(self.csvfile):
+            self.header = None
+            return 0
+
+        self.header = sorted([*columns, 'timestamp'])
+        text = csv_text(timestamps, columns)
+        with open(self.csvfile, "w") as ff:
+            ff.write(text)
+        print('Rebuilt', self.csvfile)
+        return len(text.encode())
+
+    def append(self, records):
+        columns = set().union(*(record.keys() for record in records))
+        if self.header is None or not columns.issubset(self.header) or not os.path.exists(self.csvfile):
+            return self.rebuild()
+
+        text = ''.join(csv_line([record.get(key, '') for key in self.header]) for record in records)
+        with open(self.csvfile, "a") as ff:
+            ff.write(text)
+        print('Updated', self.csvfile)
+        return len(text.encode())
+
+
+def numeric(values):
+    """Yields (row, value) of the values that are numbers; the values are strings as stored."""
+    for row, value in enumerate(values):
+        if value:
+            try:
+                number = float(value)
+            except ValueError:
+                continue
+            if number == number: # Not NaN
+                yield row, number
+
+
+def lttb(timestamps, values, points):
+    """Largest-Triangle-Three-Buckets - picks at most points of the line (timestamps, values) so that it
+    looks the same when plotted. Returns the indexes of the points picked."""
+    n = len(values)
+    if n <= points or points < 3:
+        return list(range(n)) if n <= points else [0, n - 1][:points]
+
+    every = (n - 2) / (points - 2)
+    picked = [0]
+    a = 0
+    for i in range(points - 2):
+        # The average point of the next bucket is the third vertex of the triangles
+        next_start, next_end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, n)
+        avg_x = sum(timestamps[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(values[next_start:next_end]) / (next_end - next_start)
+
+        ax, ay = timestamps[a], values[a]
+        best, best_area = None, -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (values[j] - ay) - (ax - timestamps[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        picked.append(best)
+        a = best
+    picked.append(n - 1)
+    return picked
+
+
+def downsample(timestamps, columns, points):
+    """Keeps the rows picked by LTTB for any numeric column - at most points rows per column.
+
+    The rows are kept as they are (strings), so a graph script gets the same columns as with all the data.
+    """
+    rows = set()
+    for column in columns.values():
+        numeric_rows = list(numeric(column))
+        if len(numeric_rows) <= points:
+            rows.update(row for row, _ in numeric_rows)
+            continue
+        picked = lttb([timestamps[row] for row, _ in numeric_rows], [value for _, value in numeric_rows], points)
+        rows.update(numeric_rows[i][0] for i in picked)
+
+    rows = sorted(rows)
+    return array('q', (timestamps[row] for row in rows)), {key: [column[row] for row in rows]
+                                                           for key, column in columns.items()}
+
+
+class BucketAggregates:
+    """min, mean and max of the numeric values of each column in fixed time buckets.
+
+    The rows are added as they arrive, so the aggregates are never recomputed from the raw data.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket # microseconds
+        self.starts = [] # Sorted starts of the buckets
+        self.buckets = {} # Start -> {column: [min, max, sum, count]}
+
+    def add(self, timestamps, columns):
+        for key, column in columns.items():
+            for row, value in numeric(column):
+                start = timestamps[row] - timestamps[row] % self.bucket
+                bucket = self.buckets.get(start)
+                if bucket is None:
+                    bucket = self.buckets[start] = {}
+                    bisect.insort(self.starts, start)
+                stats = bucket.get(key)
+                if stats is None:
+                    bucket[key] = [value, value, value, 1]
+                else:
+                    stats[0] = min(stats[0], value)
+                    stats[1] = max(stats[1], value)
+                    stats[2] += value
+                    stats[3] += 1
+        return self
+
+    def read(self, start=None, end=None, edges=None):
+        """Returns (timestamps, columns) - the bucket starts and <column>_min, _mean and _max, as strings - of the
+        buckets that overlap [start, end]. edges are the aggregates of just the rows within [start, end] of the
+        buckets at the ends of the range that hold rows out of it too; they replace those buckets, so only the
+        rows in the range count."""
+        first = 0 if start is None else bisect.bisect_left(self.starts, start - start % self.bucket)
+        last = len(self.starts) if end is None else bisect.bisect_right(self.starts, end)
+        buckets = []
+        for bucket_start in self.starts[first:last]:
+            bucket = self.buckets[bucket_start]
+            if edges is not None and bucket_start in edges.starts:
+                bucket = edges.buckets[bucket_start]
+            elif edges is not None and self.partial(bucket_start, start, end):
+                continue # None of its rows is in the range
+            buckets.append((bucket_start, bucket))
+
+        timestamps = array('q', (bucket_start for bucket_start, _ in buckets))
+        keys = sorted(set().union(*(bucket for _, bucket in buckets)))
+        columns = {f'{key}_{stat}': [] for key in keys for stat in ('min', 'mean', 'max')}
+        for _, bucket in buckets:
+            for key in keys:
+                stats = bucket.get(key)
+                columns[f'{key}_min'].append(str(stats[0]) if stats else '')
+                columns[f'{key}_mean'].append(str(stats[2] / stats[3]) if stats else '')
+                columns[f'{key}_max'].append(str(stats[1]) if stats else '')
+        return timestamps, columns
+
+    def partial(self, bucket_start, start, end):
+        """True if the bucket holds times out of [start, end] as well as in it."""
+        return ((start is not None and bucket_start < start <= bucket_start + self.bucket - 1)
+                or (end is not None and bucket_start <= end < bucket_start + self.bucket - 1))
+
+
+class ColumnStore:
+    """The dataset kept in memory as columns, ready to be handed over to the graph script.
+
+    Timestamps are int64 microseconds since epoch, values are strings as in the 2minlog cloud (an empty
+    string where a record has no value). Timestamps are parsed once when a record arrives, so building
+    the DataFrames for a render does not parse any text.
+    """
+
+    max_aggregates = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timestamps = array('q')
+        self.columns = {}
+        self.first_row = 0 # Number of the first row kept; the rows before it were dropped by the retention
+        self.aggregates = {} # Bucket (microseconds) -> BucketAggregates of the rows kept
+        self.sorted = True # The timestamps are in order, so the rows of a time range are found by bisection
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def load(self, log, start=None):
+        self.extend(*log.read(start=start))
+        print(f'Loaded {len(self)} records')
+
+    def append(self, records):
+        self.extend(*to_columns(records))
+
+    def extend(self, timestamps, columns):
+        with self.lock:
+            n = len(self.timestamps)
+            for key in columns:
+                if key not in self.columns:
+                    self.columns[key] = [''] * n
+            for key, column in self.columns.items():
+                column.extend(columns.get(key) or [''] * len(timestamps))
+            if self.sorted and len(timestamps) > 0:
+                self.sorted = ((n == 0 or self.timestamps[-1] <= timestamps[0])
+                               and all(a <= b for a, b in zip(timestamps, timestamps[1:])))
+            self.timestamps.extend(timestamps)
+            for aggregates in self.aggregates.values():
+                aggregates.add(timestamps, columns)
+
+    def trim(self, max_points, cutoff):
+        """Drops the oldest rows - over max_points, and from the start those older than cutoff (microseconds)."""
+        with self.lock:
+            drop = 0
+            if max_points is not None:
+                drop = max(0, len(self.timestamps) - max_points)
+            if cutoff is not None:
+                while drop < len(self.timestamps) and self.timestamps[drop] < cutoff:
+                    drop += 1
+            if drop == 0:
+                return
+
+            del self.timestamps[:drop]
+            for column in self.columns.values():
+                del column[:drop]
+            self.first_row += drop
+            self.aggregates.clear() # Rebuilt by the next aggregate()
+
+    def aggregate(self, bucket, start=None, end=None):
+        """min/mean/max in buckets of bucket microseconds of the rows within [start, end]. The aggregates of the
+        last few bucket sizes asked for are cached and updated with each new row; just the buckets at the ends of
+        the range, which may hold rows out of it, are aggregated again from the rows in the range."""
+        with self.lock:
+            aggregates = self.aggregates.get(bucket)
+            if aggregates is None:
+                if len(self.aggregates) >= self.max_aggregates:
+                    del self.aggregates[next(iter(self.aggregates))]
+                aggregates = self.aggregates[bucket] = BucketAggregates(bucket).add(self.timestamps, self.columns)
+
+            edges = BucketAggregates(bucket)
+            for bucket_start in {edge - edge % bucket for edge in (start, end) if edge is not None}:
+                if aggregates.partial(bucket_start, start, end):
+                    low = bucket_start if start is None else max(bucket_start, start)
+                    high = bucket_start + bucket - 1 if end is None else min(bucket_start + bucket - 1, end)
+                    rows = self.rows_between(low, high)
+                    edges.add(array('q', (self.timestamps[row] for row in rows)),
+                              {key: [column[row] for row in rows] for key, column in self.columns.items()})
+            return aggregates.read(start, end, edges)
+
+    def rows_between(self, low, high):
+        """The rows with low <= timestamp <= high."""
+        if self.sorted:
+            return range(bisect.bisect_left(self.timestamps, low), bisect.bisect_right(self.timestamps, high))
+        return [row for row, timestamp in enumerate(self.timestamps) if low <= timestamp <= high]
+
+    def version(self):
+        """Changes with every row added or dropped."""
+        with self.lock:
+            return self.first_row, self.first_row + len(self.timestamps)
+
+    def rows_since(self, start):
+        """Returns (first_row, timestamps, columns) - the number of the first row kept, and the rows from
+        the row number start on (row numbers count the dropped rows too)."""
+        with self.lock:
+            start = max(0, start - self.first_row)
+            return (self.first_row, self.timestamps[start:],
+                    {key: column[start:] for key, column in self.columns.items()})
+
+
+class DatasetWriter(threading.Thread):
+    """The only thread that writes the RAWDATAFILE and CSVFILE of a dataset.
+
+    Request handlers just put the records into the queue and return, so a slow file write or image
+    generation never blocks other devices, and the files never get interleaved partial writes.
+
+    Everything that is waiting in the queue is committed together (group commit) - with one append to
+    RAWDATAFILE, one CSV update and, with FSYNC_POLICY = 'commit', one fsync. With STORAGE = 'segments' a
+    commit appends to each file of each day it touches (the timestamps and every column) and fsyncs each of
+    them - the values before the timestamps, which is what keeps an interrupted commit recoverable. The
+    records are then added to the in-memory column store.
+    """
+
+    def __init__(self, name, log, materializer, store, renderer):
+        super().__init__(name=f'writer-{name}', daemon=True)
+        self.dataset_name = name
+        self.log = log
+        self.materializer = materializer
+        self.store = store
+        self.renderer = renderer
+        self.queue = queue.Queue()
+
+    def call(self, function):
+        """Queues function() to run in this thread, after the records queued before it are committed - the
+        maintenance of the files, e.g. the compaction, which must not run beside the commits. The returned
+        event is set once it ran, with its error set to the exception it raised, else None."""
+        done = threading.Event()
+        done.error = None
+        self.queue.put((function, False, done))
+        return done
+
+    def submit(self, records, render=False):
+        """Queues the records; the returned event is set once they are committed - with its error set to the
+        exception if they could not be stored, else None."""
+        committed = threading.Event()
+        committed.error = None
+        self.queue.put((records, render, committed))
+        return committed
+
+    def commit(self, records):
+        started = time.perf_counter()
+        metrics.inc('bytes_written_total', self.log.append(records), dataset=self.dataset_name, file='data')
+        self.store.append(records)
+        metrics.observe('commit_seconds', time.perf_counter() - started, dataset=self.dataset_name)
+        if CSV_EXPORT:
+            started = time.perf_counter()
+            metrics.inc('bytes_written_total', self.materializer.append(records), dataset=self.dataset_name, file='csv')
+            metrics.observe('csv_seconds', time.perf_counter() - started, dataset=self.dataset_name)
+
+    def run(self):
+        while True:
+            batches = [self.queue.get()]
+            while True:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            calls = [batch for batch in batches if callable(batch[0])]
+            batches = [batch for batch in batches if not callable(batch[0])]
+            records = [record for batch_records, _, _ in batches for record in batch_records]
+            render = any(batch_render for _, batch_render, _ in batches)
+            error = None
+            try:
+                if records:
+                    self.commit(records)
+            except Exception as e:
+                print(f"Failed to store {len(records)} records: {e}")
+                error = e
+            finally:
+                for _, _, committed in batches:
+                    committed.error = error
+                    committed.set()
+
+            if render:
+                self.renderer.mark_dirty()
+
+            for function, _, done in calls:
+                try:
+                    function()
+                except Exception as e:
+                    done.error = e
+                finally:
+                    done.set()
+
+
+class RenderScheduler(threading.Thread):
+    """Generates the image in the background, decoupled from the /log responses.
+
+    A log only marks the dataset dirty. The dirty flag is cleared when a render starts, so during a burst
+    of logs there is at most one render in flight plus one pending, and the renders start at least
+    min_interval seconds apart. The render work follows the display refresh rate, not the ingest rate.
+    """
+
+    def __init__(self, name, render, min_interval):
+        super().__init__(name=f'renderer-{name}', daemon=True)
+        self.render = render
+        self.min_interval = min_interval
+        self.dirty = threading.Event()
+
+    def mark_dirty(self):
+        self.dirty.set()
+
+    def run(self):
+        last_start = None
+        while True:
+            self.dirty.wait()
+            if last_start is not None:
+                time.sleep(max(0, last_start + self.min_interval - time.monotonic()))
+
+            self.dirty.clear()
+            last_start = time.monotonic()
+            try:
+                self.render()
+            except Exception as e:
+                print("Render failed:", e)
+
+
+def parse_records(body):
+    """Parses the body of POST /log - a JSON object, a JSON array of objects, or NDJSON (one object per line).
+
+    The whole batch is validated before anything gets stored; raises ValueError if any record is invalid.
+    """
+    try:
+        records = json.loads(body)
+    except json.JSONDecodeError as e:
+        lines = [line for line in body.split('\n') if line.strip()]
+        if len(lines) < 2:
+            raise ValueError(f"Failed to parse JSON: {e.msg}")
+        records = []
+        for n, line in enumerate(lines, 1):
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Failed to parse JSON: {e.msg} in line {n}")
+
+    if isinstance(records, dict):
+        records = [records]
+    if not isinstance(records, list):
+        raise ValueError("Expected a JSON object or an array of objects")
+
+    return validate_records(records)
+
+
+def validate_records(records):
+    for n, record in enumerate(records, 1):
+        if not isinstance(record, dict):
+            raise ValueError(f"Record {n} is not a JSON object")
+        if 'timestamp' in record:
+            try:
+                datetime.fromisoformat(str(record['timestamp']))
+            except ValueError:
+                raise ValueError(f"Record {n} has invalid timestamp {record['timestamp']!r}, expected ISO 8601")
+
+    return records
+
+
+def handle_data(records, secret=None, render=False):
+    """Routes the records to their datasets - by their datasetSecret field, or the secret of the request.
+
+    With FSYNC_POLICY = 'commit' it waits until the records are on disk, and raises OSError if they could not
+    be stored.
+    """
+    timestamp = utc_now().isoformat()
+    shards = {}
+    for content in records:
+        dataset = datasets_by_secret.get(content.pop('datasetSecret', None) or secret, default_dataset)
+        if 'timestamp' in content:
+            content['timestamp'] = normalize_timestamp(content['timestamp'])
+        else:
+            content["timestamp"] = timestamp
+        shards.setdefault(dataset, []).append(content)
+
+    committed = []
+    for dataset, dataset_records in shards.items():
+        print(f'Received {len(dataset_records)} records for {dataset.name}: {dataset_records[:3]}')
+        metrics.inc('ingest_records_total', len(dataset_records), dataset=dataset.name)
+        committed.append(dataset.writer.submit(dataset_records, render))
+    if FSYNC_POLICY == 'commit':
+        for event in committed:
+            event.wait()
+        errors = [event.error for event in committed if event.error is not None]
+        if errors:
+            raise OSError(f"Failed to store the records: {errors[0]}")
+
+def load_script(script):
+    """Imports the graph script as a module, the same way 2minlog runs it - without its local-run block."""
+    module = types.ModuleType('two_minlog_script')
+    module.__file__ = script
+    module.TWO_MINLOG_EXECUTION_ENV = 'local-server'
+    with open(script, 'r') as f:
+        source = f.read()
+    exec(compile(source, script, 'exec'), module.__dict__)
+    return module
+
+
+class FrameBuilder:
+    """Keeps the DataFrame of the dataset in the render worker, extended by the rows sent by the server.
+
+    With points, it keeps the numeric values of the frame too - converted once, as the rows arrive - for the
+    downsampled frame handed to the script.
+    """
+
+    def __init__(self, points=None):
+        self.points = points
+        self.frame = None
+        self.numbers = None # The values of the frame as floats, NaN if not a number
+        self.first_row = 0
+        self.version = 0 # Changes with every row added or dropped
+        self.downsampled = None # (version, frame) of the last downsample_frame()
+
+    def trim(self, first_row):
+        """Drops the rows before first_row, dropped by the retention in the server."""
+        if self.frame is not None and first_row > self.first_row:
+            self.frame = self.frame.iloc[first_row - self.first_row:]
+            if self.numbers is not None:
+                self.numbers = self.numbers.iloc[first_row - self.first_row:]
+            self.version += 1
+        self.first_row = max(self.first_row, first_row)
+
+    def append(self, timestamps, columns):
+        import numpy as np
+        import pandas as pd
+
+        if len(timestamps) == 0:
+            return
+
+        self.version += 1
+        index = np.frombuffer(timestamps, dtype=np.int64).astype('datetime64[us]').astype('datetime64[ns]')
+        index = pd.DatetimeIndex(index, name='timestamp')
+        frame = pd.DataFrame(columns, index=index)
+        frame = frame[sorted(frame.columns)]
+        numbers = None
+        if self.points is not None:
+            numbers = frame.apply(lambda column: pd.to_numeric(column, errors='coerce')).astype(float)
+        if self.frame is None:
+            self.frame, self.numbers = frame, numbers
+            return
+
+        if list(frame.columns) != list(self.frame.columns):
+            header = sorted(set(self.frame.columns) | set(frame.columns))
+            self.frame = self.frame.reindex(columns=header, fill_value='')
+            frame = frame.reindex(columns=header, fill_value='')
+            if numbers is not None:
+                self.numbers = self.numbers.reindex(columns=header)
+                numbers = numbers.reindex(columns=header)
+        self.frame = pd.concat([self.frame, frame])
+        if numbers is not None:
+            self.numbers = pd.concat([self.numbers, numbers])
+
+    def dfs(self):
+        """[frame] for the script's handler(dfs); with points, the frame downsampled by downsample_frame(),
+        computed once for each version of the frame - the variants rendered in between reuse it."""
+        if self.frame is None or len(self.frame) == 0:
+            return []
+        frame = self.frame
+        if self.points is not None:
+            if self.downsampled is None or self.downsampled[0] != self.version:
+                self.downsampled = (self.version, downsample_frame(self.frame, self.numbers, self.points))
+            frame = self.downsampled[1]
+        # The script may modify the frame, so it gets a copy
+        return [frame.copy()]
+
+
+def lttb_array(x, y, points):
+    """lttb() with numpy, for the render worker - x and y are float arrays. Returns the indexes picked."""
+    import numpy as np
+
+    n = len(y)
+    if n <= points or points < 3:
+        return np.arange(n) if n <= points else np.array([0, n - 1])[:points]
+
+    # Bucket i is bounds[i]:bounds[i + 1], the same buckets as in lttb(); the last one runs to the last point
+    every = (n - 2) / (points - 2)
+    bounds = (np.arange(points - 1) * every).astype(np.int64) + 1
+    counts = np.diff(np.append(bounds, n))
+    # The average point of the next bucket is the third vertex of the triangles
+    x = x - x[0]
+    avg_x = np.add.reduceat(x, bounds[1:]) / counts[1:]
+    avg_y = np.add.reduceat(y, bounds[1:]) / counts[1:]
+
+    picked = np.empty(points, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = bounds[i], bounds[i + 1]
+        ax, ay = x[a], y[a]
+        area = np.abs((ax - avg_x[i]) * (y[start:end] - ay) - (ax - x[start:end]) * (avg_y[i] - ay))
+        a = start + int(np.argmax(area))
+        picked[i + 1] = a
+    return picked
+
+
+def downsample_frame(frame, numbers, points):
+    """downsample() of the frame in the render worker - keeps the rows picked by LTTB for any numeric column.
+    numbers holds the values of the frame as floats."""
+    import numpy as np
+
+    x = (frame.index.asi8 - frame.index.asi8[0]).astype(float)
+    rows = np.zeros(len(frame), dtype=bool)
+    for key in numbers.columns:
+        y = numbers[key].to_numpy()
+        numeric_rows = np.flatnonzero(~np.isnan(y))
+        if len(numeric_rows) > points:
+            numeric_rows = numeric_rows[lttb_array(x[numeric_rows], y[numeric_rows], points)]
+        rows[numeric_rows] = True
+    return frame[rows]
 
+
+def render_variant(module, dfs, variant):
+    """Calls the script's handler(dfs) with the figures saved in the size (w, h pixels), dpi and format of the
+    variant instead of those set by the script. A missing w or h keeps the aspect ratio of the script's figure."""
+    from matplotlib.figure import Figure
+
+    savefig = Figure.savefig
+
+    def variant_savefig(figure, *args, **kwargs):
+        dpi = kwargs.get('dpi')
+        dpi = dpi if isinstance(dpi, (int, float)) else figure.dpi
+        width, height = figure.get_size_inches() * dpi
+        dpi = variant.get('dpi', dpi)
+        w, h = variant.get('w'), variant.get('h')
+        size = figure.get_size_inches()
+        if w is not None or h is not None:
+            w = w if w is not None else h * width / height
+            h = h if h is not None else w * height / width
+            figure.set_size_inches(w / dpi, h / dpi)
+        kwargs['dpi'] = dpi
+        if 'format' in variant:
+            kwargs['format'] = variant['format']
+        try:
+            return savefig(figure, *args, **kwargs)
+        finally:
+            figure.set_size_inches(size) # The script may keep the figure for the next renders
+
+    # The script's own render_cache, if it has one, knows nothing of the variants
+    cache = getattr(module, 'render_cache', None)
+    if cache is not None:
+        module.render_cache = {}
+    Figure.savefig = variant_savefig
     try:
-        result = subprocess.run(['python', TWO_MINLOG_SCRIPT], capture_output=True, text=True, check=True)
-        print("Script output:")
-        print(30*"*")
-        print(result.stdout)
-        print(30*"*")
-        print("Successfully completed script.")
-    except subprocess.CalledProcessError as e:
-        print("An error occurred while trying to run the script:", e)
+        response = module.handler(dfs)
+    finally:
+        Figure.savefig = savefig
+        if cache is not None:
+            module.render_cache = cache
+
+    if 'format' in variant and isinstance(response.get('headers'), dict):
+        response['headers']['Content-Type'] = 'image/' + variant['format'].replace('jpg', 'jpeg')
+    return response
+
+
+class StageProfiler:
+    """Times the stages of a render - the functions of the script named in PROFILE_STAGES and Figure.savefig - and
+    measures their peak memory: the most memory allocated by Python and numpy (tracemalloc) during the stage, above
+    that at its start. A nested stage counts in its caller too, e.g. savefig in plotimg."""
+
+    def __init__(self):
+        self.stack = [] # [stage, start time, memory at the start, peak of the finished nested stages]
+        self.stages = {} # stage -> [calls, seconds, peak bytes]
+
+    def wrap(self, stage, function):
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            self.enter(stage)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit()
+        return profiled
+
+    def enter(self, stage):
+        if self.stack:
+            # The peak of the caller so far; the tracemalloc peak is reset for this stage
+            self.stack[-1][3] = max(self.stack[-1][3], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self.stages.setdefault(stage, [0, 0, 0])
+        self.stack.append([stage, time.perf_counter(), tracemalloc.get_traced_memory()[0], 0])
+
+    def exit(self):
+        stage, start, memory, nested_peak = self.stack.pop()
+        seconds = time.perf_counter() - start
+        peak = max(tracemalloc.get_traced_memory()[1], nested_peak) - memory
+        calls, total, max_peak = self.stages[stage]
+        self.stages[stage] = [calls + 1, total + seconds, max(max_peak, peak)]
+
+    def run(self, module, call):
+        """call() - a render by the script in module - with the stages wrapped for the time of the call."""
+        from matplotlib.figure import Figure
+
+        functions = {stage: getattr(module, stage) for stage in PROFILE_STAGES if callable(getattr(module, stage, None))}
+        savefig = Figure.savefig
+        for stage, function in functions.items():
+            setattr(module, stage, self.wrap(stage, function))
+        Figure.savefig = self.wrap('savefig', savefig)
+        tracemalloc.start()
+        try:
+            return call()
+        finally:
+            tracemalloc.stop()
+            Figure.savefig = savefig
+            for stage, function in functions.items():
+                setattr(module, stage, function)
+
+
+def profile_render(module, call, script, profile_dir=None):
+    """call() with its stages profiled by StageProfiler. The times (milliseconds) and peaks (bytes) are added to
+    the headers of the response, as Server-Timing and X-Render-Peak-Memory. With profile_dir, a cProfile dump of
+    the render is saved there too, named by the script and the time."""
+    profiler = StageProfiler()
+    if profile_dir is None:
+        response = profiler.run(module, call)
+    else:
+        profile = cProfile.Profile()
+        response = profiler.run(module, lambda: profile.runcall(call))
+        os.makedirs(profile_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(script))[0]
+        profile.dump_stats(os.path.join(profile_dir, f'{name}-{time.time_ns() // 1000000}.prof'))
+
+    if not isinstance(response, dict):
+        return response
+    # A copy - the script may keep the response in its cache
+    headers = dict(response.get('headers') or {})
+    headers['Server-Timing'] = ', '.join(f'{stage};dur={1000 * seconds:.1f}'
+                                         for stage, (calls, seconds, peak) in profiler.stages.items())
+    headers['X-Render-Peak-Memory'] = ', '.join(f'{stage}={peak}'
+                                                for stage, (calls, seconds, peak) in profiler.stages.items())
+    return {**response, 'headers': headers}
+
+
+def record_profile(script, response):
+    """Adds the stage times and peaks of a profiled render to the metrics; returns them as text for the log,
+    None if the render was not profiled."""
+    headers = response.get('headers') or {}
+    if not isinstance(headers, dict) or 'Server-Timing' not in headers:
+        return None
+    peaks = dict(item.split('=') for item in headers.get('X-Render-Peak-Memory', '').split(', ') if '=' in item)
+    stages = []
+    for item in headers['Server-Timing'].split(', '):
+        if ';dur=' not in item:
+            continue
+        stage, milliseconds = item.split(';dur=')
+        peak = int(peaks.get(stage, 0))
+        metrics.observe('render_stage_seconds', float(milliseconds) / 1000, script=script, stage=stage)
+        metrics.set('render_stage_peak_bytes', peak, script=script, stage=stage)
+        stages.append(f'{stage} {milliseconds} ms {peak / 1024 / 1024:.1f} MB')
+    return ', '.join(stages)
+
+
+def run_render_worker(conn, script, points=None, profile=False, profile_dir=None):
+    """Main loop of the render worker process.
+
+    The script is imported once and re-imported only when its file changes, so pandas, matplotlib and
+    the font cache are loaded just once for all the renders. Each render request brings the rows
+    added since the previous one, and the variant of the image to render (None - as the script sets it).
+    With points, the script gets the frame downsampled to that many points per column.
+    With profile, the renders are profiled by profile_render(). Each reply carries the seconds the script took
+    to import, if it was imported for this render.
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg') # Images only - pyplot does not look for a GUI backend
+    module, mtime = None, None
+    frame = FrameBuilder(points)
+    while True:
+        try:
+            first_row, timestamps, columns, variant = conn.recv()
+        except EOFError:
+            return
+
+        load_seconds = None
+        try:
+            frame.trim(first_row)
+            frame.append(timestamps, columns)
+
+            script_mtime = os.stat(script).st_mtime
+            if module is None or script_mtime != mtime:
+                started = time.perf_counter()
+                module = load_script(script)
+                load_seconds = time.perf_counter() - started
+                mtime = script_mtime
+                print(f'Loaded {script} in {load_seconds:.2f} s')
+
+            # module.handler is looked up at the call, when profile_render has wrapped it
+            if variant is None:
+                render = lambda: module.handler(frame.dfs())
+            else:
+                render = lambda: render_variant(module, frame.dfs(), variant)
+            if profile:
+                conn.send(('ok', profile_render(module, render, script, profile_dir), load_seconds))
+            else:
+                conn.send(('ok', render(), load_seconds))
+        except Exception:
+            conn.send(('error', traceback.format_exc(), load_seconds))
+
+
+class RenderWorker:
+    """A warm process that runs the graph script's handler(dfs).
+
+    The script runs in a separate process, so if it crashes or hangs, the worker is restarted and the
+    server keeps running. The worker keeps its own copy of the dataset; the server sends it only the rows
+    it does not have yet (all of them after a restart).
+    """
+
+    def __init__(self, name, script, store, points=None):
+        self.name = name
+        self.script = script
+        self.store = store
+        self.points = points
+        self.lock = threading.Lock() # One render at a time - of the image or of a variant
+        self.process = None
+        self.conn = None
+        self.rows_sent = 0
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_render_worker,
+                                       args=(child_conn, self.script, self.points, PROFILE_RENDERS, PROFILE_DIR),
+                                       name=f'render-worker-{self.name}', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.rows_sent = 0
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+            self.conn.close()
+            self.process = None
+
+    def render(self, variant=None):
+        with self.lock:
+            return self.render_locked(variant)
+
+    def render_locked(self, variant):
+        if self.process is None or not self.process.is_alive():
+            self.start()
+
+        first_row, timestamps, columns = self.store.rows_since(self.rows_sent)
+        self.conn.send((first_row, timestamps, columns, variant))
+        self.rows_sent = max(self.rows_sent, first_row) + len(timestamps)
+        if not self.conn.poll(RENDER_TIMEOUT):
+            self.stop()
+            raise RuntimeError(f"Render did not finish in {RENDER_TIMEOUT} s, the render worker was restarted")
+        try:
+            status, result, load_seconds = self.conn.recv()
+        except EOFError:
+            self.stop()
+            raise RuntimeError("The render worker crashed, it will be restarted")
+
+        if load_seconds is not None:
+            metrics.observe('script_load_seconds', load_seconds, script=self.script)
+        if status == 'error':
+            raise RuntimeError(result)
+        return result
+
+
+def image_entry(image_data, content_type, modified=None):
+    """(image_data, content_type, etag, last_modified) - the image with its HTTP validators."""
+    if content_type == 'image/jpg':
+        content_type = 'image/jpeg'
+    etag = '"' + hashlib.sha1(image_data).hexdigest()[:20] + '"'
+    last_modified = email.utils.formatdate(modified if modified is not None else time.time(), usegmt=True)
+    return image_data, content_type, etag, last_modified
+
+
+def response_image(response):
+    """The image in the response of a script - 'body' as bytes, or base64-encoded as in the cloud; None if the
+    response is not an image."""
+    body = response.get('body')
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    if response.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    return None
+
+
+class ImageCache:
+    """The latest rendered image, kept in memory together with its HTTP validators (ETag, Last-Modified)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.image = None
+
+    def load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                image_data = f.read()
+        except FileNotFoundError:
+            return
+        content_type = 'image/png' if path.endswith('.png') else 'image/jpeg'
+        self.update(image_data, content_type, os.path.getmtime(path))
+
+    def update(self, image_data, content_type, modified=None):
+        self.set(image_entry(image_data, content_type, modified))
+
+    def set(self, image):
+        with self.lock:
+            self.image = image
+
+    def get(self):
+        with self.lock:
+            return self.image
+
+
+class RenderCache:
+    """The rendered images - of each dataset and its /img variants (other size, format or dpi).
+
+    The key holds the version of the data and the hash of the script source, so an image is rendered
+    once per change of either. The least recently used images are dropped once they take more than
+    max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.images:
+                self.size -= len(self.images.pop(key)[0])
+            self.images[key] = image
+            self.size += len(image[0])
+            while self.size > self.max_bytes and len(self.images) > 1:
+                _, dropped = self.images.popitem(last=False)
+                self.size -= len(dropped[0])
+
+
+class ImageEvents(threading.Thread):
+    """Server-sent events announcing new images to the displays connected to /img/events.
+
+    The request handler sends the response headers and hands the connection over to this thread, so
+    hundreds of idle displays cost one socket each, not one thread each. The event id and data are the
+    version of the image (its ETag without quotes); a display fetches /img when it gets an event. Each
+    connection listens to the images of one dataset.
+    """
+
+    def __init__(self):
+        super().__init__(name='image-events', daemon=True)
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.clients = set() # All the connections taken over, for owns()
+        self.registered = {} # Connection -> dataset name, for the connections watched by the selector; only this thread
+        self.new_clients = []
+        self.messages = []
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+    @staticmethod
+    def message(version):
+        return f"id: {version}\nevent: image\ndata: {version}\n\n".encode()
+
+    def add(self, sock, dataset_name, current_version, known_version=None):
+        """Takes over the connection. current_version() is the version of the latest image of the dataset; the
+        client gets its event right away unless that is known_version, the last version the client has seen."""
+        with self.lock:
+            self.clients.add(sock)
+            self.new_clients.append((sock, dataset_name, current_version, known_version))
+        self.wakeup_w.send(b'x')
+
+    def owns(self, sock):
+        with self.lock:
+            return sock in self.clients
+
+    def publish(self, dataset_name, version):
+        with self.lock:
+            self.messages.append((dataset_name, self.message(version)))
+        self.wakeup_w.send(b'x')
+
+    def send(self, sock, data):
+        try:
+            if sock.send(data) == len(data):
+                return
+        except OSError:
+            pass
+        self.drop(sock) # Disconnected, or too slow to take even a small event
+
+    def drop(self, sock):
+        if sock in self.registered:
+            self.selector.unregister(sock)
+            del self.registered[sock]
+        with self.lock:
+            self.clients.discard(sock)
+        sock.close()
+
+    def run(self):
+        last_keepalive = time.monotonic()
+        while True:
+            for key, _ in self.selector.select(timeout=SSE_KEEPALIVE):
+                if key.fileobj is self.wakeup_r:
+                    try:
+                        while self.wakeup_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.drop(key.fileobj) # Closed by the client; event stream clients never send anything
+
+            with self.lock:
+                # The versions are read together with taking the messages - an image published before is among
+                # the messages or already the current version, so a new client never misses it
+                new_clients = [(sock, dataset_name, current_version(), known_version)
+                               for sock, dataset_name, current_version, known_version in self.new_clients]
+                self.new_clients = []
+                messages, self.messages = self.messages, []
+
+            if time.monotonic() - last_keepalive >= SSE_KEEPALIVE:
+                messages.append((None, b": keepalive\n\n"))
+                last_keepalive = time.monotonic()
+
+            for message_dataset, data in messages:
+                for sock, dataset_name in list(self.registered.items()):
+                    if message_dataset is None or message_dataset == dataset_name:
+                        self.send(sock, data)
+
+            # The new clients after the messages, which their current versions already cover
+            for sock, dataset_name, version, known_version in new_clients:
+                sock.setblocking(False)
+                self.selector.register(sock, selectors.EVENT_READ)
+                self.registered[sock] = dataset_name
+                initial = self.message(version) if version is not None and version != known_version else b""
+                self.send(sock, b"retry: 5000\n\n" + initial)
+
+
+def image_variant_params(par):
+    """The w, h, format and dpi of /img as a dict, empty for the image as the script renders it."""
+    variant = {}
+    for name, low, high in (('w', 16, 8192), ('h', 16, 8192), ('dpi', 10, 1200)):
+        if par.get(name):
+            variant[name] = int(par[name])
+            if not low <= variant[name] <= high:
+                raise ValueError(f"{name} must be between {low} and {high}")
+    if par.get('format'):
+        variant['format'] = par['format'].lower().replace('jpeg', 'jpg')
+        if variant['format'] not in IMAGE_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(IMAGE_FORMATS)}")
+    return variant
+
+
+def not_modified(headers, etag, last_modified):
+    if headers.get('If-None-Match') is not None:
+        tags = [tag.strip() for tag in headers['If-None-Match'].split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    if headers.get('If-Modified-Since') is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(headers['If-Modified-Since'])
+        except (TypeError, ValueError):
+            return False
+        return email.utils.parsedate_to_datetime(last_modified) <= since
+    return False
+
+
+class Dataset:
+    """Everything of one dataset - its files, in-memory data, writer, render worker and latest image.
+
+    Each dataset has its own writer thread, locks and render worker, so the datasets do not block
+    each other. config holds the optional settings from DATASETS.
+    """
+
+    def __init__(self, name, rawdatafile, csvfile, script, file_to_serve, config=None):
+        config = config or {}
+        self.name = name
+        self.rawdatafile = rawdatafile
+        self.script = script
+        self.file_to_serve = file_to_serve
+        self.storage = config.get('storage', STORAGE)
+        self.window_days = config.get('window_days', RENDER_WINDOW_DAYS)
+        self.max_points = config.get('max_points', MAX_POINTS)
+        self.max_age_days = config.get('max_age_days', MAX_AGE_DAYS)
+        self.render_points = config.get('render_points', RENDER_POINTS)
+        self.loaded_from = None # Start of the data in memory; None - all the data
+        self.log = open_log(name, rawdatafile, self.storage)
+        self.materializer = CsvMaterializer(self.log, csvfile)
+        self.store = ColumnStore()
+        self.render_worker = RenderWorker(name, script, self.store, self.render_points)
+        self.image_cache = ImageCache()
+        self.render_lock = threading.Lock()
+        self.script_stat = None
+        self.script_hash = None
+        self.renderer = RenderScheduler(name, self.generate_image, RENDER_MIN_INTERVAL)
+        self.writer = DatasetWriter(name, self.log, self.materializer, self.store, self.renderer)
+
+    def start(self):
+        self.log.open()
+        if self.storage == 'segments' and len(self.log) == 0 and os.path.exists(self.rawdatafile):
+            print(f'Importing {self.rawdatafile} into segments')
+            rawlog = RawLog(self.rawdatafile)
+            rawlog.open()
+            self.log.append_columns(*rawlog.read())
+
+        if self.window_days is not None:
+            self.loaded_from = now_us() - int(self.window_days * DAY_US)
+        self.store.load(self.log, self.loaded_from)
+        self.image_cache.load(self.file_to_serve)
+        if CSV_EXPORT:
+            self.materializer.rebuild()
+        self.writer.start()
+        self.renderer.start()
+
+    def read(self, start=None, end=None, columns=None, bucket=None, points=None):
+        """The data of /data - as stored, aggregated in buckets of bucket seconds, or downsampled to at most
+        points rows per column. The aggregates of the data in memory come from the cache of the column store."""
+        if bucket is not None:
+            bucket = int(bucket * 1000000)
+            if self.loaded_from is None or (start is not None and start >= self.loaded_from):
+                timestamps, data = self.store.aggregate(bucket, start, end)
+            else:
+                timestamps, data = BucketAggregates(bucket).add(*self.log.read(start, end)).read(start, end)
+            if columns is not None:
+                data = {key: column for key, column in data.items() if key.rsplit('_', 1)[0] in columns}
+            return timestamps, data
+
+        timestamps, data = self.log.read(start, end, columns)
+        if points is not None:
+            return downsample(timestamps, data, points)
+        return timestamps, data
+
+    def script_version(self):
+        """sha1 of the script source; the file is read again only when its mtime or size changes."""
+        try:
+            stat = os.stat(self.script)
+        except OSError:
+            return None
+        if self.script_stat != (stat.st_mtime, stat.st_size):
+            with open(self.script, 'rb') as f:
+                self.script_hash = hashlib.sha1(f.read()).hexdigest()
+            self.script_stat = (stat.st_mtime, stat.st_size)
+        return self.script_hash
+
+    def render(self, variant=None):
+        """The image for the current data and script, rendered with the size, format or dpi of variant
+        ({'w', 'h', 'format', 'dpi'}, any of them) or as the script sets it.
+
+        Returns (image, response): image from render_cache, or rendered now - then response is the response
+        of the script, and image is None if the response is not an image.
+        """
+        key = (self.name, self.store.version(), self.script_version(), tuple(sorted((variant or {}).items())))
+        image = render_cache.get(key)
+        if image is not None:
+            return image, None
+
+        with self.render_lock:
+            image = render_cache.get(key)
+            if image is not None:
+                return image, None
+            response = self.render_worker.render(variant)
+            profile = record_profile(self.script, response)
+            if profile is not None:
+                print(f'Render profile of {self.script}: {profile}')
+            image_data = response_image(response)
+            if image_data is None:
+                return None, response
+            image = image_entry(image_data, response.get('headers', {}).get('Content-Type', 'image/jpeg'))
+            render_cache.put(key, image)
+            return image, response
+
+    def image_variant(self, variant):
+        image, _ = self.render(variant)
+        if image is None:
+            raise RuntimeError("The script did not return an image")
+        return image
+
+    def compact(self):
+        """Applies max_points and max_age_days to the stored data and to the data in memory, and window_days to
+        the data in memory. Run by the writer thread, see run_retention()."""
+        cutoff = None if self.max_age_days is None else now_us() - int(self.max_age_days * DAY_US)
+        if self.log.compact(self.max_points, cutoff):
+            print(f'Compacted {self.name}, {len(self.log)} records kept')
+            if CSV_EXPORT:
+                self.materializer.rebuild()
+
+        if self.window_days is not None:
+            # loaded_from moves first - the older rows are then read from the files, not from memory
+            self.loaded_from = now_us() - int(self.window_days * DAY_US)
+            cutoff = self.loaded_from if cutoff is None else max(cutoff, self.loaded_from)
+        self.store.trim(self.max_points, cutoff)
+
+    def image_version(self):
+        """The version of the latest image - its ETag without quotes; None if there is no image yet."""
+        image = self.image_cache.get()
+        return image[2].strip('"') if image is not None else None
+
+    def generate_image(self):
+        if self.script == '':
+            return
+
+        started = time.perf_counter()
+        try:
+            image, response = self.render()
+        except RuntimeError as e:
+            metrics.inc('render_failures_total', script=self.script)
+            metrics.observe('render_seconds', time.perf_counter() - started, script=self.script)
+            print(f"An error occurred while trying to run the script {self.script}:", e)
+            return
+        if response is None:
+            metrics.inc('render_cache_hits_total', script=self.script)
+        else:
+            metrics.observe('render_seconds', time.perf_counter() - started, script=self.script)
+
+        if image is None:
+            print("Script output:")
+            print(30*"*")
+            print(response.get('body'))
+            print(30*"*")
+            return
+
+        if response is not None:
+            print(f"Successfully completed script {self.script}.")
+        current = self.image_cache.get()
+        if current is not None and current[2] == image[2]:
+            return # The same image is already served
+        with open(self.file_to_serve, 'wb') as f:
+            f.write(image[0])
+        self.image_cache.set(image)
+        image_events.publish(self.name, image[2].strip('"'))
+
+
+metrics = Metrics()
+render_cache = RenderCache(RENDER_CACHE_BYTES)
+# image_events, default_dataset, datasets_by_secret, datasets and datasets_by_name are set up when the server
+# starts, at the end of this file
+
+
+def create_datasets():
+    """The datasets of the configuration - (the default dataset, {datasetSecret: dataset}). Raises ValueError
+    if two datasets have the same name."""
+    names = [os.path.splitext(CSVFILE)[0], *(config['name'] for config in DATASETS.values())]
+    duplicate_names = sorted({name for name in names if names.count(name) > 1})
+    if duplicate_names:
+        # A dataset that shares its name (and so its files) with another one would never be started
+        raise ValueError(f"Duplicate dataset names in DATASETS (the default dataset is {names[0]!r}): "
+                         f"{', '.join(map(repr, duplicate_names))}")
+    default = Dataset(names[0], RAWDATAFILE, CSVFILE, TWO_MINLOG_SCRIPT, FILE_TO_SERVE)
+    by_secret = {
+        secret: Dataset(config['name'], 'raw_' + config['name'] + '.log', config['name'] + '.csv',
+                        config.get('script', ''), 'output_' + config['name'] + '.jpg', config)
+        for secret, config in DATASETS.items()
+    }
+    return default, by_secret
+
+
+def metrics_gauges():
+    """(name, labels, value) of the metrics measured when /metrics is read."""
+    yield 'sse_clients', {}, len(image_events.clients)
+    for dataset in datasets:
+        labels = {'dataset': dataset.name}
+        yield 'records', labels, len(dataset.log)
+        yield 'records_in_memory', labels, len(dataset.store)
+        yield 'writer_queue_depth', labels, dataset.writer.queue.qsize()
+        yield 'render_pending', labels, int(dataset.renderer.dirty.is_set())
+
+
+def run_retention():
+    """Compacts the datasets every RETENTION_INTERVAL seconds. The compaction runs in the writer thread of each
+    dataset, the only one that writes its files."""
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        for dataset in datasets:
+            done = dataset.writer.call(dataset.compact)
+            done.wait()
+            if done.error is not None:
+                print(f"Compaction of {dataset.name} failed: {done.error}")
+
+
+class LocalServer(ThreadingHTTPServer):
+    request_queue_size = 128 # Many devices and displays may connect at once
+
+    def shutdown_request(self, request):
+        if image_events.owns(request):
+            return # The connection now belongs to image_events
+        super().shutdown_request(request)
+
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive; every response needs Content-Length
+    timeout = KEEPALIVE_TIMEOUT # Each open connection holds a thread
+
+    def request_secret(self, par):
+        """datasetSecret from the query string, or the password of HTTP Basic authentication."""
+        if 'datasetSecret' in par:
+            return par['datasetSecret']
+        authorization = self.headers.get('Authorization', '')
+        if authorization.startswith('Basic '):
+            try:
+                return base64.b64decode(authorization[6:]).decode('utf-8').split(':', 1)[1]
+            except (ValueError, IndexError):
+                return None
+        return None
+
+    def request_dataset(self, par):
+        """The dataset of ?dataset=<name>, or None if a response was sent. Reading a dataset other than the
+        default one needs its datasetSecret, the same way as logging into it."""
+        dataset = datasets_by_name.get(par.get('dataset', default_dataset.name))
+        if dataset is None:
+            self.send_body(404, b"Dataset not found")
+        elif dataset is not default_dataset and datasets_by_secret.get(self.request_secret(par)) is not dataset:
+            realm = dataset.name.replace('"', '')
+            self.send_body(401, b"datasetSecret of the dataset required",
+                           {'WWW-Authenticate': f'Basic realm="{realm}"'})
+            return None
+        return dataset
+
+    def send_body(self, code, body, headers=None):
+        self.send_response(code)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
         parsed_path = urllib.parse.urlparse(self.path)
         query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
@@ -111,65 +1993,146 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         par = {pp: values[0] for pp, values in query_params.items()}
 
         if parsed_path.path == "/log":
-            handle_data(par)
-            generate_image()
+            started = time.perf_counter()
+            try:
+                handle_data(validate_records([par]), self.request_secret(par), render=True)
+                self.send_body(200, b"OK")
+                status = 200
+            except ValueError as e:
+                self.send_body(400, str(e).encode())
+                status = 400
+            except OSError as e:
+                self.send_body(503, str(e).encode())
+                status = 503
+            metrics.inc('ingest_requests_total', method='GET', status=status)
+            metrics.observe('ingest_seconds', time.perf_counter() - started, method='GET')
+
+        elif parsed_path.path == "/metrics":
+            body = metrics.export(metrics_gauges()).encode()
+            self.send_body(200, body, {'Content-Type': 'text/plain; version=0.0.4'})
+
+        elif parsed_path.path == "/data":
+            dataset = self.request_dataset(par)
+            if dataset is None:
+                return
+
+            try:
+                start, end = time_param(par.get('from')), time_param(par.get('to'))
+                bucket = float(par['bucket']) if par.get('bucket') else None
+                points = int(par['points']) if par.get('points') else None
+                if (bucket is not None and bucket <= 0) or (points is not None and points < 3):
+                    raise ValueError("bucket must be positive and points at least 3")
+            except ValueError as e:
+                self.send_body(400, f"Invalid parameter: {e}".encode())
+                return
+            columns = par['columns'].split(',') if par.get('columns') else None
+            timestamps, data = dataset.read(start, end, columns, bucket, points)
+
+            if par.get('format') == 'json':
+                body = json.dumps({'timestamp': [us_to_timestamp(t) for t in timestamps], **data})
+                self.send_body(200, body.encode(), {'Content-Type': 'application/json'})
+            else:
+                self.send_body(200, csv_text(timestamps, data).encode(), {'Content-Type': 'text/csv'})
+
+        elif parsed_path.path == "/img/events":
+            dataset = self.request_dataset(par)
+            if dataset is None:
+                return
 
             self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
             self.end_headers()
-            self.wfile.write(b"OK")
+            self.wfile.flush()
+            self.close_connection = True
+
+            known_version = par.get('v', self.headers.get('Last-Event-ID'))
+            image_events.add(self.connection, dataset.name, dataset.image_version, known_version)
 
         elif parsed_path.path == "/img":
-            try:
-                # Open the image file
-                with open(FILE_TO_SERVE, 'rb') as file:
-                    image_data = file.read()
+            dataset = self.request_dataset(par)
+            if dataset is None:
+                return
 
-                self.send_response(200)
-                self.send_header('Content-Type', 'image/jpeg')
-                self.end_headers()
+            try:
+                variant = image_variant_params(par)
+            except ValueError as e:
+                self.send_body(400, f"Invalid parameter: {e}".encode())
+                return
 
-                # Send the image data
-                self.wfile.write(image_data)
+            if not variant:
+                image = dataset.image_cache.get()
+            elif dataset.script == '':
+                image = None # No script to render the variant with
+            else:
+                try:
+                    image = dataset.image_variant(variant)
+                except RuntimeError as e:
+                    print(f"An error occurred while rendering {variant} with the script {dataset.script}:", e)
+                    self.send_body(500, b"Rendering failed")
+                    return
+            if image is None:
+                metrics.inc('img_requests_total', dataset=dataset.name, status=404)
+                self.send_body(404, b"Image not found")
+                return
 
-            except FileNotFoundError:
-                self.send_response(404)
+            image_data, content_type, etag, last_modified = image
+            validators = {'ETag': etag, 'Last-Modified': last_modified, 'Cache-Control': 'no-cache'}
+            if not_modified(self.headers, etag, last_modified):
+                metrics.inc('img_requests_total', dataset=dataset.name, status=304)
+                self.send_response(304)
+                for header, value in validators.items():
+                    self.send_header(header, value)
                 self.end_headers()
-                self.wfile.write(b"Image not found")
+                return
+
+            metrics.inc('img_requests_total', dataset=dataset.name, status=200)
+            self.send_body(200, image_data, {'Content-Type': content_type, **validators})
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Path not found")
+            self.send_body(404, b"Path not found")
         return
 
     def do_POST(self):
-
-        try:
-            parsed_path = urllib.parse.urlparse(self.path)
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            post_data = post_data.decode('utf-8')
-            post_data = json.loads(post_data)
-        except json.JSONDecodeError as e:
-            print(f"Failed to parse JSON: {e.msg}, {post_data=}")
-            post_data = json.loads('{}')
-            pass
+        started = time.perf_counter()
+        parsed_path = urllib.parse.urlparse(self.path)
+        query_params = urllib.parse.parse_qs(parsed_path.query)
+        par = {pp: values[0] for pp, values in query_params.items()}
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length)
+        post_data = post_data.decode('utf-8')
 
         if parsed_path.path == "/log":
-            print(f'{post_data=}')
-            handle_data(post_data)
-
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
+            try:
+                records = parse_records(post_data)
+                handle_data(records, self.request_secret(par), render=True)
+                self.send_body(200, b"OK")
+                status = 200
+            except ValueError as e:
+                print(e)
+                self.send_body(400, str(e).encode())
+                status = 400
+            except OSError as e:
+                self.send_body(503, str(e).encode())
+                status = 503
+            metrics.inc('ingest_requests_total', method='POST', status=status)
+            metrics.observe('ingest_seconds', time.perf_counter() - started, method='POST')
 
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Path not found")
+            self.send_body(404, b"Path not found")
         return
 
 
 if __name__ == '__main__':
-    httpd = HTTPServer((HOSTNAME, PORT), SimpleHTTPRequestHandler)
+    # Not run in the render workers - the spawn start method runs this file there again, as __mp_main__, for
+    # run_render_worker; only the definitions above are executed then
+    image_events = ImageEvents()
+    default_dataset, datasets_by_secret = create_datasets()
+    datasets = [default_dataset, *datasets_by_secret.values()]
+    datasets_by_name = {dataset.name: dataset for dataset in datasets}
+    for dataset in datasets:
+        dataset.start()
+    image_events.start()
+    threading.Thread(target=run_retention, name='retention', daemon=True).start()
+    httpd = LocalServer((HOSTNAME, PORT), SimpleHTTPRequestHandler)
     print(f"Server started at http://{HOSTNAME}:{PORT}")
     httpd.serve_forever()
@@ -16,43 +16,159 @@
 #     3. unzip poppins.zip -d /usr/share/fonts/poppins
 #     4. fc-cache -fv
 #
-# Refresh cache dir
+# Refresh cache dir (the script adds Poppins to the cache by itself, if it is not there)
 #     1. Understand where is the cache: print(matplotlib.get_cachedir())
 #     2. Delete the folder
 
 # Ignored if you run in 2minlog system:
 DATASET_NAMES = ['Arduino thermometer'] # .csv
+WINDOW_DAYS = 1 # The plotted days, the last ones; only those are read from the datasets
 OUTPUT_TYPE = 'jpg'
 
 bg_color = "black"
 fg_color = "white"
 
+import time
+import os
+import tempfile
+import_started = time.perf_counter()
+
+home = os.path.expanduser('~')
+if 'MPLCONFIGDIR' not in os.environ and not (os.path.isdir(home) and os.access(home, os.W_OK)):
+    # Matplotlib would build its font cache in a new temporary folder on each start; keep it in one instead
+    os.environ['MPLCONFIGDIR'] = os.path.join(tempfile.gettempdir(), 'matplotlib')
+import matplotlib
+matplotlib.use('Agg') # Images only - no looking for a GUI backend
+
 import matplotlib.pyplot as plt
+from matplotlib import font_manager
 import numpy as np
 from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.collections import LineCollection
 import math
 import pandas as pd
 import base64
+import io
+import hashlib
+
+IMPORT_SECONDS = time.perf_counter() - import_started # The cold start; printed when run locally
+
+# Poppins installed after matplotlib built its font cache is not in the cache; add it and save the cache, once
+if not any(font.name == 'Poppins' for font in font_manager.fontManager.ttflist):
+    for path in font_manager.findSystemFonts():
+        if os.path.basename(path).lower().startswith('poppins'):
+            font_manager.fontManager.addfont(path)
+    if any(font.name == 'Poppins' for font in font_manager.fontManager.ttflist):
+        font_manager.json_dump(font_manager.fontManager, os.path.join(
+            matplotlib.get_cachedir(), f'fontlist-v{font_manager.FontManager.__version__}.json'))
+
+numeric_columns = {} # Column names of a frame -> (its string columns found numeric, a value of each of the other
+                     # string columns that is not a number), the schema hint for the next calls
+
+def covert_to_numeric(df, drop_nonnumeric):
+    """Converts the string columns that hold only numbers (or empty strings) to numbers; the other string
+    columns are stripped of white space, or dropped if drop_nonnumeric.
+
+    All the string columns are parsed together, in one vectorized pass. The columns found numeric are
+    remembered by the column names of the frame, so the next calls with the same columns parse just those.
+    The columns are inferred again if a numeric column gets a value that is not a number, or if the value
+    that made a column non-numeric is gone (e.g. it left the time window of the dataset).
+    """
+    key = tuple(df.columns)
+    text_columns = [column for column in df.columns if not pd.api.types.is_numeric_dtype(df[column])]
+    hint = numeric_columns.get(key)
+    if hint is not None and all((df[column] == value).any() for column, value in hint[1].items()):
+        columns = hint[0]
+    else:
+        hint = None
+        columns = text_columns
+
+    raw = df[columns].to_numpy(dtype=object)
+    stripped = pd.Series(raw.ravel(order='F'), dtype=object).str.strip()
+    converted = pd.to_numeric(stripped, errors='coerce')
+    bad = (converted.isna() & (stripped != '')).to_numpy().reshape(len(columns), len(df))
+    invalid = bad.any(axis=1)
+    if hint is not None and invalid.any():
+        del numeric_columns[key] # A new kind of values, infer the columns again
+        return covert_to_numeric(df, drop_nonnumeric)
+
+    values = converted.to_numpy().reshape(len(columns), len(df))
+    stripped = stripped.to_numpy().reshape(len(columns), len(df))
+    for i, column in enumerate(columns):
+        if not invalid[i]:
+            df[column] = values[i]
+        elif not drop_nonnumeric:
+            df[column] = stripped[i]
+    if hint is None:
+        numeric_columns[key] = ([column for column, b in zip(columns, invalid) if not b],
+                                {column: raw[bad[i].argmax(), i] for i, column in enumerate(columns) if invalid[i]})
+
+    nonnumeric = [column for column in text_columns if column not in numeric_columns[key][0]]
+    if drop_nonnumeric:
+        df.drop(columns=nonnumeric, inplace=True)
+    elif hint is not None:
+        for column in nonnumeric:
+            df[column] = df[column].str.strip()
 
-def covert_to_numeric(df):
-    for column in df.columns:
-        # Make a copy of the original column data
-        original_data = df[column].copy()
-        # Attempt to convert the column to numeric types, coerce errors to NaN
-        converted_data = pd.to_numeric(df[column], errors='coerce')
-        # If the conversion introduces NaNs where there weren't any, revert to original data
-        if converted_data.isna().sum() > original_data.isna().sum():
-            df.loc[:, column] = original_data
-        else:
-            df.loc[:, column] = converted_data
     return df
 
+# The figure is built once and then only its data and labels are updated, which saves most of the time of a render
+# if the script stays loaded between the renders (as in server.py). False - a new figure each render.
+REUSE_FIGURE = True
+figure_template = None
+
+def build_figure():
+    """The figure without the data - the polar axes with the hours around, the line of the temperatures,
+    the circle at the center and the latest temperature in it.
+    Returns (fig, ax, lines, circle, latest, south_labels), the artists plotimg() sets the data to."""
+    # Create a polar plot
+    fig = plt.figure(figsize=(8, 8), dpi=100)
+    fig.patch.set_facecolor(bg_color)
+
+    ax = fig.add_subplot(111, polar=True)
+    ax.set_facecolor(bg_color)
+    ax.xaxis.grid(True, color=fg_color, linestyle='-', linewidth=2)
+    ax.yaxis.grid(True, color=fg_color, linestyle='-', linewidth=2)
+    ax.tick_params(colors=fg_color)
+    ax.spines['polar'].set_edgecolor(fg_color)
+
+    # The temperatures; drawn as the lines of ax.plot() would be
+    lines = LineCollection([], linewidth=3, capstyle='projecting', joinstyle='round', zorder=2)
+    ax.add_collection(lines, autolim=False)
+
+    # Set the direction of the zero angle
+    ax.set_theta_zero_location('N')  # 'N' for North
+
+    # Set the rotation of the plot (clockwise/counter-clockwise)
+    ax.set_theta_direction(-1)  # Clockwise
+
+    # Set labels for the angles
+    ax.set_xticks(np.linspace(0, 2 * np.pi, 24, endpoint=False))
+    ax.set_xticklabels(range(24))
+    ax.set_rlabel_position(0)  # 0 degrees is north
+
+    # Add a circle at the center
+    circle = plt.Circle((0, 0), 1,
+                        transform=ax.transData._b, facecolor=bg_color,
+                        edgecolor=fg_color, linewidth=2,
+                        zorder=10)
+    ax.add_artist(circle)
+
+    # The latest temperature inside the white circle
+    latest = ax.text(0, 0, '',
+                     horizontalalignment='center',
+                     verticalalignment='center',
+                     fontsize=42,
+                     zorder=11)
+
+    return fig, ax, lines, circle, latest, []
+
 def plotimg(df):
     plt.rcParams.update({
         'font.family': 'Poppins'
     })
 
-    df = covert_to_numeric(df)
+    df = covert_to_numeric(df, drop_nonnumeric=False)
 
     df.index = df.index.tz_localize('UTC').tz_convert('Europe/Paris')
 
@@ -63,20 +179,14 @@ def plotimg(df):
 
     # Filter to the last 24 hours
     last_date = df.index.max()  # Get the last date from the index
-    df = df[last_date - pd.Timedelta(days=1):last_date + pd.Timedelta(days=1)].copy() # Upper limit is not inclusive
+    df = df[last_date - pd.Timedelta(days=WINDOW_DAYS):last_date + pd.Timedelta(days=1)].copy() # Upper limit is not inclusive
 
     df['radians'] = (df.index.hour / 24 + df.index.minute / 24 / 60 + df.index.second / 24 / 3600 ) * 2 * np.pi
 
-    # Create a polar plot
-    fig = plt.figure(figsize=(8, 8), dpi=100)
-    fig.patch.set_facecolor(bg_color)
-
-    ax = plt.subplot(111, polar=True)
-    ax.set_facecolor(bg_color)
-    ax.xaxis.grid(True, color=fg_color, linestyle='-', linewidth=2)
-    ax.yaxis.grid(True, color=fg_color, linestyle='-', linewidth=2)
-    ax.tick_params(colors=fg_color)
-    ax.spines['polar'].set_edgecolor(fg_color)
+    global figure_template
+    if figure_template is None:
+        figure_template = build_figure()
+    fig, ax, lines, circle, latest, south_labels = figure_template
 
     # Create custom colormap
     colors = ['violet', 'indigo', 'blue', 'green', 'yellow', 'orange', 'red']
@@ -89,22 +199,12 @@ def plotimg(df):
     # Assign colors based on seconds
     norm = plt.Normalize(df['seconds'].min(), df['seconds'].max())
     sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-    df['color'] = df['seconds'].apply(lambda x: sm.to_rgba(x))
+    point_colors = sm.to_rgba(df['seconds'].to_numpy())
 
-    # Plot the data with colors
-    for i in range(len(df) - 1):
-        ax.plot(df['radians'].iloc[i:i + 2], df['temperature'].iloc[i:i + 2],
-                color=df['color'].iloc[i], linewidth=3)
-
-    # Set the direction of the zero angle
-    ax.set_theta_zero_location('N')  # 'N' for North
-
-    # Set the rotation of the plot (clockwise/counter-clockwise)
-    ax.set_theta_direction(-1)  # Clockwise
-
-    # Set labels for the angles
-    ax.set_xticks(np.linspace(0, 2 * np.pi, 24, endpoint=False))
-    ax.set_xticklabels(range(24))
+    # Plot the data with colors, a segment from each point to the next one, in the color of the point
+    points = np.column_stack([df['radians'], df['temperature']])
+    lines.set_segments(np.stack([points[:-1], points[1:]], axis=1))
+    lines.set_color(point_colors[:-1])
 
     # Set number of radial grid lines
     max_temperature = np.ceil(df['temperature'].max())
@@ -131,58 +231,77 @@ def plotimg(df):
     # Set radial grids
     radial_ticks = np.arange(min_temperature, max_temperature + base, base)
     ax.set_yticks(radial_ticks)
-    ax.set_rlabel_position(0)  # 0 degrees is north
 
     ax.set_ylim(origin_value, max_temperature)
 
-    # Add a circle at the center
-    circle_radius = max_temperature - min_temperature
-    circle = plt.Circle((0, 0), circle_radius,
-                        transform=ax.transData._b, facecolor=bg_color,
-                        edgecolor=fg_color, linewidth=2,
-                        zorder=10)
-    ax.add_artist(circle)
+    # The circle at the center
+    circle.set_radius(max_temperature - min_temperature)
 
-    # Add the latest temperature inside the white circle
+    # The latest temperature inside the white circle
     latest_temperature = df.iloc[-1]['temperature']
-    latest_color = df.iloc[-1]['color']
+    latest_color = point_colors[-1]
     print(f'{latest_temperature=}')
 
-    ax.text(0, origin_value, f'{latest_temperature:.1f}°C',
-            horizontalalignment='center',
-            verticalalignment='center',
-            fontsize=42,
-            color=latest_color,
-            zorder=11)
+    latest.set_position((0, origin_value))
+    latest.set_text(f'{latest_temperature:.1f}°C')
+    latest.set_color(latest_color)
 
     # Add second set of radial labels to the south manually
-    for r in radial_ticks:
-        ax.text(np.pi, r, f'{r:.0f}', ha='left', va='bottom', color=fg_color)
+    for label in south_labels:
+        label.remove()
+    south_labels[:] = [ax.text(np.pi, r, f'{r:.0f}', ha='left', va='bottom', color=fg_color) for r in radial_ticks]
 
-    plt.savefig('/tmp/img' + OUTPUT_TYPE, format=OUTPUT_TYPE)
-    plt.close()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=OUTPUT_TYPE)
+    if not REUSE_FIGURE:
+        plt.close(fig)
+        figure_template = None
 
-    return "/tmp/img" + OUTPUT_TYPE
+    return buffer.getvalue()
 
-def returnimg(ff):
-    with open(ff, 'rb') as image_file:
-        img = image_file.read()
+RAW_RESPONSE = globals().get('TWO_MINLOG_EXECUTION_ENV') == 'local-server' # server.py takes the image bytes as they are
 
-    body = base64.b64encode(img).decode('utf-8')
+def returnimg(img):
+    """img - the encoded image. The cloud takes it base64-encoded; the local server takes the bytes as they are,
+    with no encoding and no copy."""
+    if RAW_RESPONSE:
+        body = img
+    else:
+        body = base64.b64encode(img).decode('utf-8')
 
     response = {
         'headers': {"Content-Type": "image/" + OUTPUT_TYPE},
         'statusCode': 200,
         'body': body,
-        'isBase64Encoded': True
+        'isBase64Encoded': not RAW_RESPONSE
     }
     return response
 
+# The responses of the last renders, by the hash of the data. The script may stay loaded between the calls,
+# so the same data are not rendered twice; a changed script is loaded anew, with an empty cache.
+RENDER_CACHE_SIZE = 8
+render_cache = {}
+
+def data_hash(dfs, *extra):
+    """Hash of the data frames - the index, the column names and the values; extra is hashed too."""
+    h = hashlib.sha1(repr(extra).encode())
+    for df in dfs:
+        h.update(repr(list(df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df).values.tobytes())
+    return h.hexdigest()
+
 def handler(dfs):
+    key = data_hash(dfs)
+    if key in render_cache:
+        return render_cache[key]
+
     df = dfs[0]
-    ff = plotimg(df)
-    response = returnimg(ff)
+    img = plotimg(df)
+    response = returnimg(img)
 
+    render_cache[key] = response
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        del render_cache[next(iter(render_cache))]
     return response
 
 
@@ -192,29 +311,69 @@ OUTPUT_TYPE = 'jpg'
 
 if 'TWO_MINLOG_EXECUTION_ENV' not in globals():
     import os
-    import tempfile
     import pandas as pd
     import base64
-
-    os.makedirs("/tmp", exist_ok=True)
-    globals()['MPLCONFIGDIR'] = tempfile.mkdtemp(dir='/tmp')
-
-    csvs = []
-    for DSN in DATASET_NAMES:
-        with open( DSN + '.csv', 'r') as f:
-            data = f.readlines()
-            data = [line.strip().split(',') for line in data]
-            csvs.append(data)
-
-    dfs = []
-    for csv in csvs:
-        if csv == [[]]:
-            continue
-
-        df = pd.DataFrame(data=csv[1:], columns=csv[0])
+    import csv
+    from datetime import datetime, timedelta
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f'Imports: {IMPORT_SECONDS:.2f} s (python -X importtime shows each module)')
+
+    def reversed_lines(f, start):
+        """Yields (offset, line) of the lines of the binary file f after the offset start, from the last one."""
+        end = f.seek(0, os.SEEK_END)
+        rest = b''
+        while end > start:
+            block_start = max(start, end - 1024 * 1024)
+            f.seek(block_start)
+            data = f.read(end - block_start) + rest
+            lines = data.split(b'\n')
+            rest = lines.pop(0) if block_start > start else b'' # The first line may begin in the previous block
+            offset = block_start + len(data)
+            for line in reversed(lines):
+                offset -= len(line)
+                yield offset, line
+                offset -= 1 # The newline
+            end = block_start
+
+    def read_window(path, window_days):
+        """The header and the lines of the last window_days days of the data in the CSV file path, as bytes.
+        The file is read from the end, until the first line older than the window, so the time does not grow
+        with the history. window_days None - the whole file."""
+        with open(path, 'rb') as f:
+            header = f.readline()
+            if window_days is None or not header.strip():
+                return header + f.read()
+            column = [name.strip() for name in next(csv.reader([header.decode()]))].index('timestamp')
+            data_start = f.seek(0, os.SEEK_END)
+            newest = None
+            for offset, line in reversed_lines(f, len(header)):
+                if not line.strip():
+                    continue
+                timestamp = datetime.fromisoformat(next(csv.reader([line.decode()]))[column].strip())
+                if newest is None:
+                    newest = timestamp
+                elif timestamp < newest - timedelta(days=window_days):
+                    break
+                data_start = offset
+            f.seek(data_start)
+            return header + f.read()
+
+    def load_dataset(dataset_name):
+        """Reads DATASET_NAME.csv as the cloud passes it to handler() - string values, indexed by the timestamps."""
+        try:
+            # The C parser of pandas reads the file straight into columns; the values stay strings, as in the cloud
+            data = read_window(dataset_name + '.csv', WINDOW_DAYS)
+            df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, engine='c')
+        except pd.errors.EmptyDataError: # Not even a header
+            return None
+        df.columns = df.columns.str.strip() # Strip white spaces around elements
         df.set_index('timestamp', inplace=True)
         df.index = pd.to_datetime(df.index, format='ISO8601')
-        dfs.append(df)
+        return df
+
+    with ThreadPoolExecutor() as executor: # The datasets are read in parallel
+        dfs = [df for df in executor.map(load_dataset, DATASET_NAMES) if df is not None]
 
     result = handler(dfs)
 
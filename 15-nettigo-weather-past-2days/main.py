@@ -1,19 +1,33 @@
 # pip install numpy pandas seaborn Pillow testresources astral
 
+import os
+import tempfile
+
+home = os.path.expanduser('~')
+if 'MPLCONFIGDIR' not in os.environ and not (os.path.isdir(home) and os.access(home, os.W_OK)):
+    # Matplotlib would build its font cache in a new temporary folder on each start; keep it in one instead
+    os.environ['MPLCONFIGDIR'] = os.path.join(tempfile.gettempdir(), 'matplotlib')
+import matplotlib
+matplotlib.use('Agg') # Images only - no looking for a GUI backend
+
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import pandas as pd
 from datetime import datetime, timedelta
 import pytz
 import base64
+import io
+import hashlib
 from astral.sun import sun
 from astral import LocationInfo
 import matplotlib.transforms as transforms
 
+WINDOW_DAYS = 2 # The plotted days, the last ones
+
 def preprocess(df):
     df.index = df.index.tz_localize('UTC')
 
-    cutoff_time = datetime.now(pytz.timezone('Europe/Prague')) - timedelta(days=2)
+    cutoff_time = datetime.now(pytz.timezone('Europe/Prague')) - timedelta(days=WINDOW_DAYS)
 
     df = df[df.index > cutoff_time]
 
@@ -161,31 +175,59 @@ def plotimg(df_dict):
     # Setting up the x-axis to cover the full date range of the data
     host.set_xlim([dft.index.min(), dft.index.max()])
 
-    plt.savefig('/tmp/img.jpg', format='jpg')
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format='jpg')
     plt.close()
 
-    return "/tmp/img.jpg"
+    return buffer.getvalue()
 
-def returnimg(ff):
-    with open(ff, 'rb') as image_file:
-        img = image_file.read()
+RAW_RESPONSE = globals().get('TWO_MINLOG_EXECUTION_ENV') == 'local-server' # server.py takes the image bytes as they are
 
-    body = base64.b64encode(img).decode('utf-8')
+def returnimg(img):
+    """img - the encoded image. The cloud takes it base64-encoded; the local server takes the bytes as they are,
+    with no encoding and no copy."""
+    if RAW_RESPONSE:
+        body = img
+    else:
+        body = base64.b64encode(img).decode('utf-8')
 
     response = {
         'headers': {"Content-Type": "image/jpg"},
         'statusCode': 200,
         'body': body,
-        'isBase64Encoded': True
+        'isBase64Encoded': not RAW_RESPONSE
     }
     return response
 
 
+# The responses of the last renders, by the hash of the data. The script may stay loaded between the calls,
+# so the same data are not rendered twice; a changed script is loaded anew, with an empty cache.
+RENDER_CACHE_SIZE = 8
+render_cache = {}
+
+
+def data_hash(dfs, *extra):
+    """Hash of the data frames - the index, the column names and the values; extra is hashed too."""
+    h = hashlib.sha1(repr(extra).encode())
+    for df in dfs:
+        h.update(repr(list(df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df).values.tobytes())
+    return h.hexdigest()
+
+
 def handler(dfs):
+    # The graph depends on the current time too
+    key = data_hash(dfs, pd.Timestamp.now().floor('min'))
+    if key in render_cache:
+        return render_cache[key]
+
     df = dfs[0]
     df = preprocess(df)
-    ff = plotimg(df)
+    img = plotimg(df)
 
-    response = returnimg(ff)
+    response = returnimg(img)
 
+    render_cache[key] = response
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        del render_cache[next(iter(render_cache))]
     return response
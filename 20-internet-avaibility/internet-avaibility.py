@@ -19,38 +19,139 @@
 ###
 
 DATASET_NAMES = ['intervalping']  # .csv
+WINDOW_DAYS = 5 * 7 # The plotted days, the last ones; only those are read from the datasets
 OUTPUT_TYPE = 'png'
 
+import time
+import os
+import tempfile
+import_started = time.perf_counter()
+
+home = os.path.expanduser('~')
+if 'MPLCONFIGDIR' not in os.environ and not (os.path.isdir(home) and os.access(home, os.W_OK)):
+    # Matplotlib would build its font cache in a new temporary folder on each start; keep it in one instead
+    os.environ['MPLCONFIGDIR'] = os.path.join(tempfile.gettempdir(), 'matplotlib')
+import matplotlib
+matplotlib.use('Agg') # Images only - no looking for a GUI backend
+
 import pandas as pd
 import base64
+import io
+import hashlib
 import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 import numpy as np
 import matplotlib.colors as mcolors
 
+IMPORT_SECONDS = time.perf_counter() - import_started # The cold start; printed when run locally
 
-def covert_to_numeric(df, drop_nonnumeric):
-    columns_to_drop = []
-    for column in df.columns:
-        original_data = df[column].copy()
-        original_data = original_data.str.strip()
-        mask_empty = original_data == ''
-        converted_data = pd.to_numeric(original_data, errors='coerce')
-        converted_data_masked = converted_data.copy()
-        converted_data_masked[mask_empty] = 0  # Convert empty strings as NaN
-
-        if converted_data_masked.isna().sum() > 0:
-            df.loc[:, column] = original_data
-            columns_to_drop.append(column)
-        else:
-            df.loc[:, column] = converted_data
 
+numeric_columns = {} # Column names of a frame -> (its string columns found numeric, a value of each of the other
+                     # string columns that is not a number), the schema hint for the next calls
+
+
+def covert_to_numeric(df, drop_nonnumeric):
+    """Converts the string columns that hold only numbers (or empty strings) to numbers; the other string
+    columns are stripped of white space, or dropped if drop_nonnumeric.
+
+    All the string columns are parsed together, in one vectorized pass. The columns found numeric are
+    remembered by the column names of the frame, so the next calls with the same columns parse just those.
+    The columns are inferred again if a numeric column gets a value that is not a number, or if the value
+    that made a column non-numeric is gone (e.g. it left the time window of the dataset).
+    """
+    key = tuple(df.columns)
+    text_columns = [column for column in df.columns if not pd.api.types.is_numeric_dtype(df[column])]
+    hint = numeric_columns.get(key)
+    if hint is not None and all((df[column] == value).any() for column, value in hint[1].items()):
+        columns = hint[0]
+    else:
+        hint = None
+        columns = text_columns
+
+    raw = df[columns].to_numpy(dtype=object)
+    stripped = pd.Series(raw.ravel(order='F'), dtype=object).str.strip()
+    converted = pd.to_numeric(stripped, errors='coerce')
+    bad = (converted.isna() & (stripped != '')).to_numpy().reshape(len(columns), len(df))
+    invalid = bad.any(axis=1)
+    if hint is not None and invalid.any():
+        del numeric_columns[key] # A new kind of values, infer the columns again
+        return covert_to_numeric(df, drop_nonnumeric)
+
+    values = converted.to_numpy().reshape(len(columns), len(df))
+    stripped = stripped.to_numpy().reshape(len(columns), len(df))
+    for i, column in enumerate(columns):
+        if not invalid[i]:
+            df[column] = values[i]
+        elif not drop_nonnumeric:
+            df[column] = stripped[i]
+    if hint is None:
+        numeric_columns[key] = ([column for column, b in zip(columns, invalid) if not b],
+                                {column: raw[bad[i].argmax(), i] for i, column in enumerate(columns) if invalid[i]})
+
+    nonnumeric = [column for column in text_columns if column not in numeric_columns[key][0]]
     if drop_nonnumeric:
-        df.drop(columns=columns_to_drop, inplace=True)
+        df.drop(columns=nonnumeric, inplace=True)
+    elif hint is not None:
+        for column in nonnumeric:
+            df[column] = df[column].str.strip()
 
     return df
 
 
+# The figure is built once and then only its data, titles and day labels are updated, which saves most of the time
+# of a render if the script stays loaded between the renders (as in server.py). False - a new figure each render.
+REUSE_FIGURE = True
+figure_template = None
+
+
+def build_figure():
+    """The figure without the data - the five week blocks with their ticks, labels and colors.
+    Returns (fig, images, titles, day_labels), the artists plotimg() sets the data to."""
+    # fig, axs = plt.subplots(1, 5, figsize=(10.24, 6), dpi=300, gridspec_kw={'wspace': 0.5, 'hspace': 0.3})
+    fig, axs = plt.subplots(1, 5, figsize=(10.24, 6 / 655 * 600 - 0.05), dpi=200 / 1738 * 1024,
+                            gridspec_kw={'wspace': 0.5, 'hspace': 0.3})
+    # fig, axs = plt.subplots(1, 5, figsize=(30, 12), gridspec_kw={'wspace': 0.3})  # 5 blocks with more space between them
+
+    fig.patch.set_facecolor('black')
+    cmap = mcolors.ListedColormap(['black', 'gray', 'red',
+                                   'green', ])  # Gray for padding, red for missing, green for actual data # Frankly no idea, why swapped green & red.
+    bounds = [-2.5, -1.5, -0.5, 0.5, 1.5]
+    norm = mcolors.BoundaryNorm(bounds, cmap.N)
+
+    images, titles, day_labels = [], [], []
+    for i, ax in enumerate(axs):
+        images.append(ax.imshow(np.zeros((7 * 24, 60)), cmap=cmap, norm=norm, aspect='auto', interpolation='nearest'))
+        ax.set_facecolor('black')
+        ax.tick_params(colors='white', labelsize=6)
+        ax.spines['bottom'].set_color('white')
+        ax.spines['top'].set_color('white')
+        ax.spines['left'].set_color('white')
+        ax.spines['right'].set_color('white')
+
+        ax.set_xticks(np.arange(0, 60, 5))
+        ax.set_xticklabels([f"{i}" for i in range(0, 60, 5)], color='white', fontsize=6)
+
+        day_ticks = np.arange(0, 7 * 24, 24)
+        hour_ticks = np.array([0 - 1, 6 - 1, 12 - 1, 18 - 1])
+        all_ticks = np.sort(np.concatenate([day_ticks + h for h in hour_ticks]))
+        ax.set_yticks(all_ticks)
+
+        y_labels = []
+        for day_idx in range(7):
+            y_labels.extend([f'{hour}:00' for hour in [24, 18, 12, 6]])
+
+        ax.set_yticklabels(y_labels, color='white', fontsize=6)
+
+        day_labels.append([ax.text(-18, day_idx * 24 + 12, '', rotation=90, verticalalignment='center',
+                                   horizontalalignment='right', fontsize=6, color='white') for day_idx in range(7)])
+
+        titles.append(ax.set_title('', color='white', pad=8, fontsize=8))
+        ax.set_xlabel('Minute of the Hour', color='white', fontsize=6)
+
+    fig.suptitle('Internet access Vojenova (past 5 weeks)', color='white', y=0.95, fontsize=10)
+    return fig, images, titles, day_labels
+
+
 def plotimg(df):
     df = covert_to_numeric(df, drop_nonnumeric=True)
 
@@ -76,7 +177,7 @@ def plotimg(df):
 
     # Find the oldest and most recent timestamps in the data
     most_recent_time = df['timestamp'].max()
-    cutoff_date = most_recent_time - pd.Timedelta(days=5 * 7)
+    cutoff_date = most_recent_time - pd.Timedelta(days=WINDOW_DAYS)
     df = df[df['timestamp'] >= cutoff_date]
 
     oldest_time = df['timestamp'].min()
@@ -115,118 +216,89 @@ def plotimg(df):
         records_matrix = np.zeros((7 * 24, 60))  # 7 days * 24 hours, 60 minutes per hour
         for day_idx, day in enumerate(reversed(week)):  # Start from the most recent day
             day_data = df[df['date'] == day]
-            for _, row in day_data.iterrows():
-                hour_idx = row['hour_of_day']
-                minute_idx = row['minute_of_hour']
-                records_matrix[day_idx * 24 + 23 - hour_idx, minute_idx] = row['record']
-                # records_matrix[day_idx * 24 + 23 - hour_idx, minute_idx] = row['timestamp'].timestamp() # row['record']
+            hour_idx = day_data['hour_of_day'].to_numpy()
+            minute_idx = day_data['minute_of_hour'].to_numpy()
+            records_matrix[day_idx * 24 + 23 - hour_idx, minute_idx] = day_data['record'].to_numpy()
         records_matrices.append(records_matrix)
 
     # Plotting
-    # fig, axs = plt.subplots(1, 5, figsize=(10.24, 6), dpi=300, gridspec_kw={'wspace': 0.5, 'hspace': 0.3})
-    fig, axs = plt.subplots(1, 5, figsize=(10.24, 6 / 655 * 600 - 0.05), dpi=200 / 1738 * 1024,
-                            gridspec_kw={'wspace': 0.5, 'hspace': 0.3})
-    # fig, axs = plt.subplots(1, 5, figsize=(30, 12), gridspec_kw={'wspace': 0.3})  # 5 blocks with more space between them
-
-    fig.patch.set_facecolor('black')
-    cmap = mcolors.ListedColormap(['black', 'gray', 'red',
-                                   'green', ])  # Gray for padding, red for missing, green for actual data # Frankly no idea, why swapped green & red.
-    bounds = [-2.5, -1.5, -0.5, 0.5, 1.5]
-    norm = mcolors.BoundaryNorm(bounds, cmap.N)
+    global figure_template
+    if figure_template is None:
+        figure_template = build_figure()
+    fig, images, titles, day_labels = figure_template
 
     # Plot each week in a separate block
-    for i, ax in enumerate(axs):
-        ax.imshow(records_matrices[i], cmap=cmap, norm=norm, aspect='auto', interpolation='nearest')
-        ax.set_facecolor('black')
-        ax.tick_params(colors='white', labelsize=6)
-        ax.spines['bottom'].set_color('white')
-        ax.spines['top'].set_color('white')
-        ax.spines['left'].set_color('white')
-        ax.spines['right'].set_color('white')
-
-        ax.set_xticks(np.arange(0, 60, 5))
-        ax.set_xticklabels([f"{i}" for i in range(0, 60, 5)], color='white', fontsize=6)
-
-        day_ticks = np.arange(0, 7 * 24, 24)
-        hour_ticks = np.array([0 - 1, 6 - 1, 12 - 1, 18 - 1])
-        all_ticks = np.sort(np.concatenate([day_ticks + h for h in hour_ticks]))
-        ax.set_yticks(all_ticks)
-
-        y_labels = []
-        for day_idx in range(7):
-            y_labels.extend([f'{hour}:00' for hour in [24, 18, 12, 6]])
-
-        ax.set_yticklabels(y_labels, color='white', fontsize=6)
+    for i in range(len(weeks)):
+        images[i].set_data(records_matrices[i])
 
         for day_idx, day in enumerate(reversed(weeks[i])):
-            ax.text(-18, day_idx * 24 + 12, day.strftime('%Y-%m-%d'), rotation=90,
-                    verticalalignment='center', horizontalalignment='right', fontsize=6, color='white')
+            day_labels[i][day_idx].set_text(day.strftime('%Y-%m-%d'))
 
         week_start = weeks[i][0].strftime('%Y-%m-%d')
         week_end = weeks[i][-1].strftime('%Y-%m-%d')
-        ax.set_title(f'{week_start} - {week_end}', color='white', pad=8, fontsize=8)
-        ax.set_xlabel('Minute of the Hour', color='white', fontsize=6)
+        titles[i].set_text(f'{week_start} - {week_end}')
 
-    plt.suptitle('Internet access Vojenova (past 5 weeks)', color='white', y=0.95, fontsize=10)
-    plt.savefig('/tmp/img.' + OUTPUT_TYPE, format=OUTPUT_TYPE, bbox_inches='tight', facecolor='black')
-    plt.close()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=OUTPUT_TYPE, bbox_inches='tight', facecolor='black')
+    if not REUSE_FIGURE:
+        plt.close(fig)
+        figure_template = None
 
-    return "/tmp/img." + OUTPUT_TYPE
+    return buffer.getvalue()
 
 
-def returnimg(ff):
-    with open(ff, 'rb') as image_file:
-        img = image_file.read()
+RAW_RESPONSE = globals().get('TWO_MINLOG_EXECUTION_ENV') == 'local-server' # server.py takes the image bytes as they are
 
-    body = base64.b64encode(img).decode('utf-8')
+def returnimg(img):
+    """img - the encoded image. The cloud takes it base64-encoded; the local server takes the bytes as they are,
+    with no encoding and no copy."""
+    if RAW_RESPONSE:
+        body = img
+    else:
+        body = base64.b64encode(img).decode('utf-8')
 
     response = {
         'headers': {"Content-Type": "image/" + OUTPUT_TYPE},
         'statusCode': 200,
         'body': body,
-        'isBase64Encoded': True
+        'isBase64Encoded': not RAW_RESPONSE
     }
     return response
 
 
-def handler(dfs):
-    if len(dfs) > 0:
-        df = dfs[0]
-    else:  # If dfs = [] let's set some dummy graph
-        df = pd.DataFrame({'timestamp': [0, 1], 'value': [1, 2]}).set_index('timestamp')
+# The responses of the last renders, by the hash of the data. The script may stay loaded between the calls,
+# so the same data are not rendered twice; a changed script is loaded anew, with an empty cache.
+RENDER_CACHE_SIZE = 8
+render_cache = {}
 
-    ff = plotimg(df)
 
-    response = returnimg(ff)
-
-    return response
-
-
-def returnimg(ff):
-    with open(ff, 'rb') as image_file:
-        img = image_file.read()
-
-    body = base64.b64encode(img).decode('utf-8')
-
-    response = {
-        'headers': {"Content-Type": "image/" + OUTPUT_TYPE},
-        'statusCode': 200,
-        'body': body,
-        'isBase64Encoded': True
-    }
-    return response
+def data_hash(dfs, *extra):
+    """Hash of the data frames - the index, the column names and the values; extra is hashed too."""
+    h = hashlib.sha1(repr(extra).encode())
+    for df in dfs:
+        h.update(repr(list(df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df).values.tobytes())
+    return h.hexdigest()
 
 
 def handler(dfs):
+    # The graph depends on the current time too
+    key = data_hash(dfs, pd.Timestamp.now().floor('min'))
+    if key in render_cache:
+        return render_cache[key]
+
     if len(dfs) > 0:
         df = dfs[0]
     else:  # If dfs = [] let's set some dummy graph
         df = pd.DataFrame({'timestamp': [0, 1], 'value': [1, 2]}).set_index('timestamp')
 
-    ff = plotimg(df)
+    img = plotimg(df)
 
-    response = returnimg(ff)
+    response = returnimg(img)
 
+    render_cache[key] = response
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        del render_cache[next(iter(render_cache))]
     return response
 
 
@@ -235,30 +307,68 @@ def handler(dfs):
 
 if 'TWO_MINLOG_EXECUTION_ENV' not in globals():
     import os
-    import tempfile
     import pandas as pd
     import base64
-
-    os.makedirs("/tmp", exist_ok=True)
-    globals()['MPLCONFIGDIR'] = tempfile.mkdtemp(dir='/tmp')
-
-    csvs = []
-    for DSN in DATASET_NAMES:
-        with open(DSN + '.csv', 'r') as f:
-            data = f.readlines()
-            data = [line.strip().split(',') for line in data]
-            csvs.append(data)
-
-    dfs = []
-    for csv in csvs:
-        if csv == [[]]:
-            continue
-
-        df = pd.DataFrame(data=csv[1:], columns=csv[0])
-        df.columns = df.columns.str.strip()  # Strip white spaces around elements
+    import csv
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f'Imports: {IMPORT_SECONDS:.2f} s (python -X importtime shows each module)')
+
+    def reversed_lines(f, start):
+        """Yields (offset, line) of the lines of the binary file f after the offset start, from the last one."""
+        end = f.seek(0, os.SEEK_END)
+        rest = b''
+        while end > start:
+            block_start = max(start, end - 1024 * 1024)
+            f.seek(block_start)
+            data = f.read(end - block_start) + rest
+            lines = data.split(b'\n')
+            rest = lines.pop(0) if block_start > start else b'' # The first line may begin in the previous block
+            offset = block_start + len(data)
+            for line in reversed(lines):
+                offset -= len(line)
+                yield offset, line
+                offset -= 1 # The newline
+            end = block_start
+
+    def read_window(path, window_days):
+        """The header and the lines of the last window_days days of the data in the CSV file path, as bytes.
+        The file is read from the end, until the first line older than the window, so the time does not grow
+        with the history. window_days None - the whole file."""
+        with open(path, 'rb') as f:
+            header = f.readline()
+            if window_days is None or not header.strip():
+                return header + f.read()
+            column = [name.strip() for name in next(csv.reader([header.decode()]))].index('timestamp')
+            data_start = f.seek(0, os.SEEK_END)
+            newest = None
+            for offset, line in reversed_lines(f, len(header)):
+                if not line.strip():
+                    continue
+                timestamp = datetime.fromisoformat(next(csv.reader([line.decode()]))[column].strip())
+                if newest is None:
+                    newest = timestamp
+                elif timestamp < newest - timedelta(days=window_days):
+                    break
+                data_start = offset
+            f.seek(data_start)
+            return header + f.read()
+
+    def load_dataset(dataset_name):
+        """Reads DATASET_NAME.csv as the cloud passes it to handler() - string values, indexed by the timestamps."""
+        try:
+            # The C parser of pandas reads the file straight into columns; the values stay strings, as in the cloud
+            data = read_window(dataset_name + '.csv', WINDOW_DAYS)
+            df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, engine='c')
+        except pd.errors.EmptyDataError: # Not even a header
+            return None
+        df.columns = df.columns.str.strip() # Strip white spaces around elements
         df.set_index('timestamp', inplace=True)
         df.index = pd.to_datetime(df.index, format='ISO8601')
-        dfs.append(df)
+        return df
+
+    with ThreadPoolExecutor() as executor: # The datasets are read in parallel
+        dfs = [df for df in executor.map(load_dataset, DATASET_NAMES) if df is not None]
 
     result = handler(dfs)
 
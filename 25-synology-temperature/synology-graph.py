@@ -8,10 +8,25 @@
 
 
 DATASET_NAMES = ['Synology temp - do not delete'] # .csv
+WINDOW_DAYS = 7 # The plotted days, the last ones; only those are read from the datasets
 OUTPUT_TYPE = 'png'
 
+import time
+import os
+import tempfile
+import_started = time.perf_counter()
+
+home = os.path.expanduser('~')
+if 'MPLCONFIGDIR' not in os.environ and not (os.path.isdir(home) and os.access(home, os.W_OK)):
+    # Matplotlib would build its font cache in a new temporary folder on each start; keep it in one instead
+    os.environ['MPLCONFIGDIR'] = os.path.join(tempfile.gettempdir(), 'matplotlib')
+import matplotlib
+matplotlib.use('Agg') # Images only - no looking for a GUI backend
+
 import pandas as pd
 import base64
+import io
+import hashlib
 import matplotlib.pyplot as plt
 
 import pandas as pd
@@ -24,6 +39,8 @@ import numpy as np
 import matplotlib.collections as mcoll
 from matplotlib.colors import LinearSegmentedColormap
 
+IMPORT_SECONDS = time.perf_counter() - import_started # The cold start; printed when run locally
+
 # Function to plot colored lines based on temperature
 def colorline(x, y, z=None, cmap='Greens', norm=None, linewidth=2, ax=None):
     if ax is None:
@@ -54,7 +71,7 @@ def plotimg(df):
 
     # Filter data for the last week
     now = pd.Timestamp.now(tz='Europe/Berlin')
-    one_week_ago = now - pd.Timedelta(days=7)
+    one_week_ago = now - pd.Timedelta(days=WINDOW_DAYS)
     data = data[data['datetime'] >= one_week_ago]
 
     # Group the data by 'server_name' and 'name'
@@ -128,36 +145,62 @@ def plotimg(df):
     # Adjust layout and save the figure
     plt.tight_layout()
 
-    plt.savefig('/tmp/img' + OUTPUT_TYPE, format=OUTPUT_TYPE, facecolor=fig.get_facecolor(), dpi=dpi)
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format=OUTPUT_TYPE, facecolor=fig.get_facecolor(), dpi=dpi)
     plt.close()
 
-    return "/tmp/img" + OUTPUT_TYPE
+    return buffer.getvalue()
 
 
-def returnimg(ff):
-    with open(ff, 'rb') as image_file:
-        img = image_file.read()
+RAW_RESPONSE = globals().get('TWO_MINLOG_EXECUTION_ENV') == 'local-server' # server.py takes the image bytes as they are
 
-    body = base64.b64encode(img).decode('utf-8')
+def returnimg(img):
+    """img - the encoded image. The cloud takes it base64-encoded; the local server takes the bytes as they are,
+    with no encoding and no copy."""
+    if RAW_RESPONSE:
+        body = img
+    else:
+        body = base64.b64encode(img).decode('utf-8')
 
     response = {
         'headers': {"Content-Type": "image/" + OUTPUT_TYPE},
         'statusCode': 200,
         'body': body,
-        'isBase64Encoded': True
+        'isBase64Encoded': not RAW_RESPONSE
     }
     return response
 
+# The responses of the last renders, by the hash of the data. The script may stay loaded between the calls,
+# so the same data are not rendered twice; a changed script is loaded anew, with an empty cache.
+RENDER_CACHE_SIZE = 8
+render_cache = {}
+
+def data_hash(dfs, *extra):
+    """Hash of the data frames - the index, the column names and the values; extra is hashed too."""
+    h = hashlib.sha1(repr(extra).encode())
+    for df in dfs:
+        h.update(repr(list(df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df).values.tobytes())
+    return h.hexdigest()
+
 def handler(dfs):
+    # The graph depends on the current time too
+    key = data_hash(dfs, pd.Timestamp.now().floor('min'))
+    if key in render_cache:
+        return render_cache[key]
+
     if len(dfs) > 0:
         df = dfs[0]
     else: # If dfs = [] let's set some dummy graph
         df = pd.DataFrame({'timestamp': [0,1], 'value': [1,2]}).set_index('timestamp')
 
-    ff = plotimg(df)
+    img = plotimg(df)
 
-    response = returnimg(ff)
+    response = returnimg(img)
 
+    render_cache[key] = response
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        del render_cache[next(iter(render_cache))]
     return response
 
 
@@ -165,31 +208,68 @@ def handler(dfs):
 ### Code to run locally, mimicking the cloud environment
 if 'TWO_MINLOG_EXECUTION_ENV' not in globals():
     import os
-    import tempfile
     import pandas as pd
     import base64
-
-    os.makedirs("/tmp", exist_ok=True)
-    globals()['MPLCONFIGDIR'] = tempfile.mkdtemp(dir='/tmp')
-
-    csvs = []
-    for DSN in DATASET_NAMES:
-        with open( DSN + '.csv', 'r') as f:
-            data = f.readlines()
-            data = [line.strip().split(',') for line in data]
-            csvs.append(data)
-
-    dfs = []
-    for csv in csvs:
-        if csv == [[]]:
-            continue
-
-        df = pd.DataFrame(data=csv[1:], columns=csv[0])
+    import csv
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f'Imports: {IMPORT_SECONDS:.2f} s (python -X importtime shows each module)')
+
+    def reversed_lines(f, start):
+        """Yields (offset, line) of the lines of the binary file f after the offset start, from the last one."""
+        end = f.seek(0, os.SEEK_END)
+        rest = b''
+        while end > start:
+            block_start = max(start, end - 1024 * 1024)
+            f.seek(block_start)
+            data = f.read(end - block_start) + rest
+            lines = data.split(b'\n')
+            rest = lines.pop(0) if block_start > start else b'' # The first line may begin in the previous block
+            offset = block_start + len(data)
+            for line in reversed(lines):
+                offset -= len(line)
+                yield offset, line
+                offset -= 1 # The newline
+            end = block_start
+
+    def read_window(path, window_days):
+        """The header and the lines of the last window_days days of the data in the CSV file path, as bytes.
+        The file is read from the end, until the first line older than the window, so the time does not grow
+        with the history. window_days None - the whole file."""
+        with open(path, 'rb') as f:
+            header = f.readline()
+            if window_days is None or not header.strip():
+                return header + f.read()
+            column = [name.strip() for name in next(csv.reader([header.decode()]))].index('timestamp')
+            data_start = f.seek(0, os.SEEK_END)
+            newest = None
+            for offset, line in reversed_lines(f, len(header)):
+                if not line.strip():
+                    continue
+                timestamp = datetime.fromisoformat(next(csv.reader([line.decode()]))[column].strip())
+                if newest is None:
+                    newest = timestamp
+                elif timestamp < newest - timedelta(days=window_days):
+                    break
+                data_start = offset
+            f.seek(data_start)
+            return header + f.read()
+
+    def load_dataset(dataset_name):
+        """Reads DATASET_NAME.csv as the cloud passes it to handler() - string values, indexed by the timestamps."""
+        try:
+            # The C parser of pandas reads the file straight into columns; the values stay strings, as in the cloud
+            data = read_window(dataset_name + '.csv', WINDOW_DAYS)
+            df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, engine='c')
+        except pd.errors.EmptyDataError: # Not even a header
+            return None
         df.columns = df.columns.str.strip() # Strip white spaces around elements
         df.set_index('timestamp', inplace=True)
         df.index = pd.to_datetime(df.index, format='ISO8601')
+        return df
 
-        dfs.append(df)
+    with ThreadPoolExecutor() as executor: # The datasets are read in parallel
+        dfs = [df for df in executor.map(load_dataset, DATASET_NAMES) if df is not None]
 
     result = handler(dfs)
 
@@ -203,4 +283,4 @@ if 'TWO_MINLOG_EXECUTION_ENV' not in globals():
         print(result['body'])
         print(80*'*')
 ### End of code to run locally, mimicking the cloud environment
-#################################################################
\ No newline at end of file
+#################################################################
\ No newline at end of file